@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# Measures mapping throughput without a webcam or a WLED: the real mapping code talks
+# ArtNet to a local receiver, reads frames from a simulated camera that renders the
+# receiver's LEDs, and talks HTTP to a stub WLED.
+#
+#   python -m benchmarks.mapping_benchmark --leds 300 --fps 60 --latency 0.03
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import statistics
+import tempfile
+import time
+
+from benchmarks.simulation import (
+    ArtNetReceiver,
+    DdpReceiver,
+    FakeVideoCapture,
+    StubWledServer,
+    make_serpentine_layout,
+)
+from led_camera_map import camera, format_map, led_control_wled, mapping, timing
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def get_accuracy(locations, positions, tolerance):
+    found = 0
+    correct = 0
+    for location, position in zip(locations, positions):
+        if location == (-1, -1):
+            continue
+        found += 1
+        if (
+            abs(location[0] - position[0]) <= tolerance
+            and abs(location[1] - position[1]) <= tolerance
+        ):
+            correct += 1
+    return found, correct
+
+
+async def benchmark_mapping(args, positions, output_dir):
+    if args.transport == "ddp":
+        receiver = DdpReceiver(args.leds)
+    else:
+        receiver = ArtNetReceiver(args.leds)
+    receiver.start()
+    video_capture = FakeVideoCapture(
+        receiver,
+        positions,
+        args.width,
+        args.height,
+        fps=args.fps,
+        latency=args.latency,
+        noise=args.noise,
+    )
+    camera.open_camera = lambda _camera_id: video_capture
+    mapping.MAPPING_MODE = args.mode
+    mapping.LED_TRANSPORT = args.transport
+
+    start = time.perf_counter()
+    locations = await mapping.map_leds(
+        args.brightness, args.threshold, args.leds, "127.0.0.1", output_dir
+    )
+    elapsed = time.perf_counter() - start
+    camera.close_camera_sessions()
+    receiver.close()
+
+    lit_times = [receiver.first_lit[i] for i in sorted(receiver.first_lit)]
+    step_times = [later - earlier for earlier, later in zip(lit_times, lit_times[1:])]
+    found, correct = get_accuracy(locations, positions, args.tolerance)
+    return {
+        "mode": args.mode,
+        "transport": args.transport,
+        "leds": args.leds,
+        "seconds": elapsed,
+        "leds_per_second": args.leds / elapsed,
+        "frames_read": video_capture.frames_read,
+        "led_packets": receiver.packets,
+        "per_led_ms_p50": get_percentile(step_times, 50) * 1000,
+        "per_led_ms_p95": get_percentile(step_times, 95) * 1000,
+        "per_led_ms_mean": statistics.fmean(step_times) * 1000 if step_times else 0,
+        "found": found,
+        "correct": correct,
+        "accuracy": correct / args.leds,
+    }, locations
+
+
+def benchmark_wled_http(args, locations, output_dir):
+    server = StubWledServer(args.leds, reboot_time=args.reboot_time)
+    server.start()
+    wled_ip = server.address
+
+    start = time.perf_counter()
+    led_control_wled.get_led_count(wled_ip)
+    info_seconds = time.perf_counter() - start
+
+    values, width, height = format_map.flatten_2d_map(locations)
+    format_map.save_wled_json(
+        mapping.LED_MAP_OUTPUT_NAME, values, width, height, output_dir
+    )
+    start = time.perf_counter()
+    led_control_wled.apply_ledmap(wled_ip, mapping.LED_MAP_OUTPUT_NAME, output_dir)
+    first_apply_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    led_control_wled.apply_ledmap(wled_ip, mapping.LED_MAP_OUTPUT_NAME, output_dir)
+    unchanged_apply_seconds = time.perf_counter() - start
+    server.close()
+    return {
+        "info_ms": info_seconds * 1000,
+        "first_apply_ms": first_apply_seconds * 1000,
+        "unchanged_apply_ms": unchanged_apply_seconds * 1000,
+        "http_requests": server.requests,
+    }
+
+
+def print_report(results):
+    print()
+    print("==== Mapping benchmark ====")
+    for key, value in results.items():
+        if isinstance(value, float):
+            print(f"{key:>20}: {value:.3f}")
+        else:
+            print(f"{key:>20}: {value}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark LED mapping against a simulated camera and WLED"
+    )
+    parser.add_argument("--leds", type=int, default=200)
+    parser.add_argument(
+        "--mode", choices=("single", "gray_code", "rgb"), default="single"
+    )
+    parser.add_argument("--transport", choices=("artnet", "ddp"), default="artnet")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=float, default=60)
+    parser.add_argument("--latency", type=float, default=0.03)
+    parser.add_argument("--noise", type=float, default=4)
+    parser.add_argument("--brightness", type=int, default=255)
+    parser.add_argument("--threshold", type=int, default=150)
+    parser.add_argument("--tolerance", type=int, default=3)
+    parser.add_argument("--reboot-time", type=float, default=0.5)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--trace", help="Save a Chrome trace of every stage here")
+    args = parser.parse_args()
+
+    if args.trace:
+        timing.enable()
+
+    positions = make_serpentine_layout(args.leds, args.width, args.height)
+    with tempfile.TemporaryDirectory() as output_dir:
+        results, locations = await benchmark_mapping(args, positions, output_dir)
+        results.update(benchmark_wled_http(args, locations, output_dir))
+
+    print_report(results)
+    if args.trace:
+        timing.print_summary()
+        timing.export_chrome_trace(args.trace)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+import bisect
+import json
+import math
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2 as cv
+import numpy as np
+
+from led_camera_map.led_control_artnet import LEDS_PER_UNIVERSE, CHANNELS_PER_LED
+from led_camera_map.led_control_ddp import DDP_FLAGS_PUSH, DDP_PORT
+
+ARTNET_PORT = 6454
+ARTNET_HEADER = b"Art-Net\x00"
+ARTDMX_OPCODE = 0x5000
+
+
+def make_serpentine_layout(num_leds, width=1280, height=720, spacing=14):
+    # A strip zig-zagging across the frame, like a typical LED wall
+    per_row = max(1, (width - 2 * spacing) // spacing)
+    positions = []
+    for i in range(num_leds):
+        row, column = divmod(i, per_row)
+        if row % 2:
+            column = per_row - 1 - column
+        positions.append((spacing + column * spacing, spacing + row * spacing))
+    if positions and positions[-1][1] >= height:
+        raise ValueError("Layout doesn't fit into the frame, use fewer LEDs")
+    return positions
+
+
+class ArtNetReceiver(threading.Thread):
+    # Stands in for WLED: decodes ArtDMX packets in "Dimmer + Multi RGB" mode and
+    # keeps a timestamped history of the LED colours so a camera can lag behind.
+    def __init__(self, num_leds, host="127.0.0.1", port=ARTNET_PORT):
+        super().__init__(name="artnet-receiver", daemon=True)
+        self.num_leds = num_leds
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((host, port))
+        self._socket.settimeout(0.1)
+        self._universes: dict[int, bytes] = {}
+        self._lock = threading.Lock()
+        self._times: list[float] = [0.0]
+        self._states: list[np.ndarray] = [np.zeros((num_leds, 3), dtype=np.uint8)]
+        self.first_lit: dict[int, float] = {}
+        self.packets = 0
+        self._running = True
+
+    def run(self):
+        while self._running:
+            try:
+                packet = self._socket.recv(1024)
+            except socket.timeout:
+                continue
+            if packet[:8] != ARTNET_HEADER:
+                continue
+            if int.from_bytes(packet[8:10], "little") != ARTDMX_OPCODE:
+                continue
+            universe = int.from_bytes(packet[14:16], "little")
+            length = int.from_bytes(packet[16:18], "big")
+            self._universes[universe] = packet[18 : 18 + length]
+            self.packets += 1
+            self._record_state(self._decode_state(), time.monotonic())
+
+    def _decode_state(self):
+        state = np.zeros((self.num_leds, 3), dtype=np.float32)
+        dimmer = 0
+        for universe, data in self._universes.items():
+            offset = 0
+            if universe == 0:
+                dimmer = data[0] if data else 0
+                offset = 1
+            first_led = universe * LEDS_PER_UNIVERSE
+            leds = min(
+                (len(data) - offset) // CHANNELS_PER_LED, self.num_leds - first_led
+            )
+            if leds <= 0:
+                continue
+            channels = np.frombuffer(
+                data, dtype=np.uint8, count=leds * CHANNELS_PER_LED, offset=offset
+            )
+            state[first_led : first_led + leds] = channels.reshape(leds, 3)
+        return (state * dimmer / 255).astype(np.uint8)
+
+    def _record_state(self, state, now):
+        for i in np.flatnonzero(state.any(axis=1)):
+            self.first_lit.setdefault(int(i), now)
+        with self._lock:
+            self._times.append(now)
+            self._states.append(state)
+
+    def get_state(self, at_time):
+        with self._lock:
+            index = bisect.bisect_right(self._times, at_time) - 1
+            return self._states[max(0, index)]
+
+    def close(self):
+        self._running = False
+        self.join()
+        self._socket.close()
+
+
+class DdpReceiver(ArtNetReceiver):
+    # Stands in for WLED receiving DDP: packets write RGB data at their offset and the
+    # LEDs change once a packet with the push flag arrives
+    def __init__(self, num_leds, host="127.0.0.1", port=DDP_PORT):
+        super().__init__(num_leds, host, port)
+        self.name = "ddp-receiver"
+        self._pixels = bytearray(num_leds * CHANNELS_PER_LED)
+
+    def run(self):
+        while self._running:
+            try:
+                packet = self._socket.recv(2048)
+            except socket.timeout:
+                continue
+            offset = int.from_bytes(packet[4:8], "big")
+            length = int.from_bytes(packet[8:10], "big")
+            data = packet[10 : 10 + length][: len(self._pixels) - offset]
+            self._pixels[offset : offset + len(data)] = data
+            self.packets += 1
+            if packet[0] & DDP_FLAGS_PUSH:
+                state = np.frombuffer(bytes(self._pixels), dtype=np.uint8)
+                self._record_state(state.reshape(-1, 3), time.monotonic())
+
+
+class FakeVideoCapture:
+    # Renders what a camera would see of the receiver's LEDs, with a frame rate,
+    # a delay between the LED changing and the camera seeing it, and sensor noise.
+    def __init__(
+        self,
+        receiver,
+        positions,
+        width=1280,
+        height=720,
+        fps=60,
+        latency=0.03,
+        noise=4,
+        ambient=20,
+        led_radius=3,
+    ):
+        self._receiver = receiver
+        self._positions = positions
+        self._frame_interval = 1 / fps
+        self._latency = latency
+        self._led_radius = led_radius
+        self._next_frame = time.monotonic()
+        self.frames_read = 0
+
+        # Generating noise for every frame would cost more than the mapping itself,
+        # so cycle through a few pre-rendered noisy backgrounds instead
+        rng = np.random.default_rng(0)
+        self._backgrounds = []
+        for _ in range(8 if noise else 1):
+            background = rng.normal(ambient, noise, (height, width, 3))
+            self._backgrounds.append(np.clip(background, 0, 255).astype(np.uint8))
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        now = time.monotonic()
+        if now < self._next_frame:
+            time.sleep(self._next_frame - now)
+            now = self._next_frame
+        self._next_frame = now + self._frame_interval
+        self.frames_read += 1
+
+        state = self._receiver.get_state(now - self._latency)
+        frame = self._backgrounds[self.frames_read % len(self._backgrounds)].copy()
+        for i in np.flatnonzero(state.any(axis=1)):
+            red, green, blue = (int(value) for value in state[i])
+            cv.circle(
+                frame, self._positions[i], self._led_radius, (blue, green, red), -1
+            )
+        return True, frame
+
+    def set(self, _property, _value):
+        return True
+
+    def get(self, _property):
+        return 0
+
+    def release(self):
+        pass
+
+
+class StubWledServer(ThreadingHTTPServer):
+    # Just enough of WLED's HTTP API for led_control_wled: /json/info, /json/state,
+    # /edit uploads, /reset and serving uploaded files.
+    def __init__(self, num_leds, host="127.0.0.1", port=0, reboot_time=0.5):
+        super().__init__((host, port), StubWledHandler)
+        self.num_leds = num_leds
+        self.reboot_time = reboot_time
+        self.files: dict[str, bytes] = {}
+        self.maps = [{"id": 0, "n": "ledmap0.json"}]
+        self.state = {"on": True, "ledmap": 0}
+        self.booted_at = time.monotonic()
+        self.requests = 0
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        host, port = self.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+    def reboot(self):
+        self.booted_at = time.monotonic() + self.reboot_time
+        for name in self.files:
+            match = re.fullmatch(r"/ledmap(\d*)\.json", name)
+            if match is None:
+                continue
+            ledmap_id = int(match.group(1) or 0)
+            if all(ledmap["id"] != ledmap_id for ledmap in self.maps):
+                self.maps.append({"id": ledmap_id, "n": name[1:]})
+
+
+class StubWledHandler(BaseHTTPRequestHandler):
+    server: StubWledServer
+
+    def log_message(self, *_args):
+        pass
+
+    def _reply(self, status, body=b"", content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _rebooting(self):
+        # Drop the connection like a rebooting ESP32 would
+        if time.monotonic() < self.server.booted_at:
+            self.close_connection = True
+            return True
+        return False
+
+    def do_HEAD(self):
+        self.server.requests += 1
+        if self._rebooting():
+            return
+        self._reply(200)
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self._rebooting():
+            return
+        if self.path == "/json/info":
+            info = {
+                "leds": {"countP": self.server.num_leds},
+                "maps": self.server.maps,
+                "uptime": math.floor(time.monotonic() - self.server.booted_at),
+            }
+            self._reply(200, json.dumps(info).encode())
+        elif self.path == "/json/state":
+            self._reply(200, json.dumps(self.server.state).encode())
+        elif self.path == "/reset":
+            self._reply(200, b"Rebooting...", "text/plain")
+            self.server.reboot()
+        elif self.path in self.server.files:
+            self._reply(200, self.server.files[self.path])
+        else:
+            self._reply(404)
+
+    def do_POST(self):
+        self.server.requests += 1
+        if self._rebooting():
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/edit":
+            match = re.search(rb'filename="([^"]+)"', body)
+            if match is None:
+                self._reply(400)
+                return
+            content = body.split(b"\r\n\r\n", 1)[1].rsplit(b"\r\n--", 1)[0]
+            self.server.files[match.group(1).decode()] = content
+            self._reply(200, b"", "text/plain")
+        elif self.path == "/json/state":
+            self.server.state.update(json.loads(body))
+            self._reply(200, b'{"success":true}')
+        else:
+            self._reply(404)
@@ -3,10 +3,19 @@ from __future__ import annotations
 import asyncio
 import multiprocessing as mp
 import os
-import queue
+import threading
+import time
 import cv2 as cv
+import numpy as np
 
-FRAMES_SAVED_COUNTER = 0
+from led_camera_map import timing
+
+# Colour channels of a BGR frame, in the order of led_control_artnet.RGB_COLORS
+RGB_CHANNELS = (2, 1, 0)
+# Frames this wide are first searched at 1/COARSE_STEP of their size while mapping.
+# LEDs narrower than 3 pixels are ignored anyway, so a step of 3 can't miss any.
+COARSE_MIN_WIDTH = 1600
+COARSE_STEP = 3
 
 
 def do_nothing(_):
@@ -47,71 +56,554 @@ def create_threshold(grey_image, threshold):
     return threshold_image
 
 
-def locate_led_in_image(threshold_image, minimum_dimension=3):
+def locate_led_in_image(threshold_image, minimum_dimension=3, draw=True):
+    # Without draw, no contour image is made and None is returned in its place
     minimum_dimension = 3
 
-    edged_image = threshold_image.copy()
-    contours, _ = cv.findContours(edged_image, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+    # findContours only changed its input image before OpenCV 3.2
+    edged_image = threshold_image.copy() if draw else threshold_image
+    contours, _ = cv.findContours(
+        edged_image, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE
+    )
 
     if len(contours) > 0:
         biggest_contour = max(contours, key=cv.contourArea)
         x, y, w, h = cv.boundingRect(biggest_contour)
 
         if w >= minimum_dimension and h >= minimum_dimension:
-            contour_image = cv.cvtColor(threshold_image, cv.COLOR_GRAY2RGB)
-            cv.rectangle(contour_image, (x, y), (x + w, y + h), (0, 0, 255), 2)
             cx = int(x + (w / 2))
             cy = int(y + (h / 2))
+            if not draw:
+                return (cx, cy), None
+            contour_image = cv.cvtColor(threshold_image, cv.COLOR_GRAY2RGB)
+            cv.rectangle(contour_image, (x, y), (x + w, y + h), (0, 0, 255), 2)
             return (cx, cy), contour_image
 
-    return (-1, -1), edged_image  # Nothing found in this image
+    # Nothing found in this image
+    return (-1, -1), edged_image if draw else None
 
 
-def get_led_position(frame, threshold, save_image=False, minimum_dimension=3):
+def capture_dark_frame(vc, num_frames=5):
+    # Median of a few frames with all LEDs off, so flicker and noise stay out of it
+    gray_frames = []
+    for _ in range(num_frames):
+        frame = get_frame(vc)
+        if frame is not None:
+            gray_frames.append(cv.cvtColor(frame, cv.COLOR_BGR2GRAY))
+    if not gray_frames:
+        return None
+    return np.median(np.stack(gray_frames), axis=0).astype(np.uint8)
+
+
+def count_changed_pixels(gray_image, reference_gray_image, threshold):
+    difference = cv.absdiff(gray_image, reference_gray_image)
+    return cv.countNonZero(create_threshold(difference, threshold))
+
+
+def wait_for_led_change(
+    vc,
+    reference_frame,
+    timeout,
+    change_threshold=30,
+    minimum_changed_pixels=4,
+    stable_frames=2,
+):
+    # Read frames until one differs from the reference (the LED changed), then until
+    # consecutive frames stop changing (the LED and the camera exposure settled).
+    # Returns the last frame and whether the timeout was hit first.
+    deadline = time.monotonic() + timeout
+    reference_gray_image = cv.cvtColor(reference_frame, cv.COLOR_BGR2GRAY)
+    frame = None
+    previous_gray_image = None
+    changed = False
+    stable_count = 0
+    while time.monotonic() < deadline:
+        new_frame = get_frame(vc)
+        if new_frame is None:
+            break
+        frame = new_frame
+        gray_image = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        if not changed:
+            changed = (
+                count_changed_pixels(gray_image, reference_gray_image, change_threshold)
+                >= minimum_changed_pixels
+            )
+        elif (
+            count_changed_pixels(gray_image, previous_gray_image, change_threshold)
+            < minimum_changed_pixels
+        ):
+            stable_count += 1
+            if stable_count >= stable_frames:
+                return frame, False
+        else:
+            stable_count = 0
+        previous_gray_image = gray_image
+    return frame, True
+
+
+def get_channel_image(frame, channel):
+    # How much brighter one colour channel is than the brightest of the other two, so
+    # white light and the LEDs lit in the other colours drop out
+    channels = cv.split(frame)
+    others = [channels[index] for index in range(3) if index != channel]
+    return cv.subtract(channels[channel], cv.max(*others))
+
+
+def get_detection_images(frame, dark_frame=None, channel=None):
+    # The grey image to threshold, and the grey image of the frame itself
+    if channel is not None:
+        # Neutral ambient light already cancels out, so there's no dark frame to use
+        gray_image = get_channel_image(frame, channel)
+        return gray_image, gray_image
     gray_image = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
-    threshold_image = create_threshold(gray_image, threshold)
-    location, contour_image = locate_led_in_image(threshold_image, minimum_dimension)
-    if save_image:
-        global FRAMES_SAVED_COUNTER
-        cv.imwrite("out/led" + str(FRAMES_SAVED_COUNTER) + ".png", contour_image)
-        FRAMES_SAVED_COUNTER += 1
+    if dark_frame is not None:
+        # Only threshold what changed since the dark frame, so ambient light is ignored
+        return cv.absdiff(gray_image, dark_frame), gray_image
+    return gray_image, gray_image
+
+
+def find_led_in_frame(
+    frame, threshold, minimum_dimension=3, dark_frame=None, channel=None, draw=True
+):
+    detection_image, gray_image = get_detection_images(frame, dark_frame, channel)
+    threshold_image = create_threshold(detection_image, threshold)
+    location, contour_image = locate_led_in_image(
+        threshold_image, minimum_dimension, draw
+    )
+    return location, contour_image, gray_image
 
+
+def find_led_in_window(
+    frame,
+    window,
+    threshold,
+    minimum_dimension=3,
+    dark_frame=None,
+    channel=None,
+    draw=True,
+):
+    # Like find_led_in_frame, but only inside window, in full frame coordinates
+    x0, y0, x1, y1 = window
+    window_dark_frame = None if dark_frame is None else dark_frame[y0:y1, x0:x1]
+    location, contour_image, gray_image = find_led_in_frame(
+        frame[y0:y1, x0:x1],
+        threshold,
+        minimum_dimension,
+        window_dark_frame,
+        channel,
+        draw,
+    )
+    if location != (-1, -1):
+        location = (location[0] + x0, location[1] + y0)
     return location, contour_image, gray_image
 
 
+def find_led_coarse_to_fine(
+    frame,
+    threshold,
+    minimum_dimension=3,
+    dark_frame=None,
+    channel=None,
+    step=COARSE_STEP,
+    max_candidates=4,
+):
+    # Looks for blobs in a copy of the frame with only every step-th pixel of every
+    # step-th row, which still has a pixel of every LED that locate_led_in_image
+    # would accept. Only the windows around the biggest of those blobs are then
+    # searched at full resolution.
+    height, width = frame.shape[:2]
+    coarse_size = (width // step, height // step)
+    coarse_frame = cv.resize(frame, coarse_size, interpolation=cv.INTER_NEAREST)
+    coarse_dark_frame = None
+    if dark_frame is not None:
+        coarse_dark_frame = cv.resize(
+            dark_frame, coarse_size, interpolation=cv.INTER_NEAREST
+        )
+    detection_image, _ = get_detection_images(coarse_frame, coarse_dark_frame, channel)
+    contours, _ = cv.findContours(
+        create_threshold(detection_image, threshold),
+        cv.RETR_EXTERNAL,
+        cv.CHAIN_APPROX_SIMPLE,
+    )
+    candidates = sorted(contours, key=cv.contourArea, reverse=True)
+    for contour in candidates[:max_candidates]:
+        x, y, w, h = cv.boundingRect(contour)
+        # Grown by one coarse pixel, the LED's edge can lie between two samples
+        window = (
+            max(0, (x - 1) * step),
+            max(0, (y - 1) * step),
+            min(width, (x + w + 1) * step),
+            min(height, (y + h + 1) * step),
+        )
+        location, _, _ = find_led_in_window(
+            frame, window, threshold, minimum_dimension, dark_frame, channel, False
+        )
+        if location != (-1, -1):
+            return location
+    return (-1, -1)
+
+
+def predict_search_window(locations, i, frame_shape, margin=40, lookback=12):
+    # Consecutive LEDs on a strip sit next to each other, so extrapolate LED i from the
+    # last two LEDs before it that were found. Entries that are None aren't known yet.
+    recent = []
+    for index in range(i - 1, max(-1, i - 1 - lookback), -1):
+        location = locations[index]
+        if location is not None and location != (-1, -1):
+            recent.insert(0, (index, location))
+            if len(recent) == 2:
+                break
+    if not recent:
+        return None
+    last_index, (last_x, last_y) = recent[-1]
+    step_x, step_y = 0.0, 0.0
+    if len(recent) >= 2:
+        first_index, (first_x, first_y) = recent[0]
+        step_x = (last_x - first_x) / (last_index - first_index)
+        step_y = (last_y - first_y) / (last_index - first_index)
+    gap = i - last_index
+    predicted_x = last_x + step_x * gap
+    predicted_y = last_y + step_y * gap
+    # Span the last LED found and the prediction, widened the further ahead we guess
+    margin = margin * gap
+    height, width = frame_shape[:2]
+    x0 = max(0, int(min(last_x, predicted_x) - margin))
+    y0 = max(0, int(min(last_y, predicted_y) - margin))
+    x1 = min(width, int(max(last_x, predicted_x) + margin) + 1)
+    y1 = min(height, int(max(last_y, predicted_y) + margin) + 1)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return x0, y0, x1, y1
+
+
+def get_led_position(
+    frame,
+    threshold,
+    minimum_dimension=3,
+    dark_frame=None,
+    search_window=None,
+    channel=None,
+    debug_images=True,
+):
+    # With a channel, only LEDs lit in that colour are looked for, see RGB_CHANNELS.
+    # Without debug_images only the location is found, and frames at least
+    # COARSE_MIN_WIDTH wide are searched coarse to fine. None is returned for both
+    # images then.
+    location = (-1, -1)
+    if search_window is not None:
+        location, contour_image, gray_image = find_led_in_window(
+            frame,
+            search_window,
+            threshold,
+            minimum_dimension,
+            dark_frame,
+            channel,
+            debug_images,
+        )
+
+    if location == (-1, -1):
+        # No window, or nothing in it: search the whole frame
+        if not debug_images and frame.shape[1] >= COARSE_MIN_WIDTH:
+            location = find_led_coarse_to_fine(
+                frame, threshold, minimum_dimension, dark_frame, channel
+            )
+        else:
+            location, contour_image, gray_image = find_led_in_frame(
+                frame, threshold, minimum_dimension, dark_frame, channel, debug_images
+            )
+    if not debug_images:
+        return location, None, None
+    return location, contour_image, gray_image
+
+
+def decode_gray_code_frames(frame_pairs, threshold, num_leds, minimum_pixels=1):
+    # frame_pairs holds one (pattern, complement) pair of BGR frames per gray code bit.
+    # A pixel belongs to an LED only if it is lit in exactly one frame of every pair.
+    if any(frame is None for frame_pair in frame_pairs for frame in frame_pair):
+        # Without every bit no pixel can be told apart from half the others
+        print("A gray code frame is missing, no LED can be decoded")
+        return [(-1, -1)] * num_leds
+    code = None
+    valid = None
+    for bit, (pattern_frame, complement_frame) in enumerate(frame_pairs):
+        lit = create_threshold(cv.cvtColor(pattern_frame, cv.COLOR_BGR2GRAY), threshold)
+        lit_complement = create_threshold(
+            cv.cvtColor(complement_frame, cv.COLOR_BGR2GRAY), threshold
+        )
+        lit = lit > 0
+        if code is None:
+            code = np.zeros(lit.shape, dtype=np.int32)
+            valid = np.ones(lit.shape, dtype=bool)
+        code |= lit.astype(np.int32) << bit
+        valid &= lit != (lit_complement > 0)
+
+    # Convert gray code back to the LED index
+    shift = 1
+    while shift < len(frame_pairs):
+        code ^= code >> shift
+        shift <<= 1
+
+    ys, xs = np.nonzero(valid)
+    indexes = code[ys, xs]
+    in_range = indexes < num_leds
+    ys, xs, indexes = ys[in_range], xs[in_range], indexes[in_range]
+
+    counts = np.bincount(indexes, minlength=num_leds)
+    sum_x = np.bincount(indexes, weights=xs, minlength=num_leds)
+    sum_y = np.bincount(indexes, weights=ys, minlength=num_leds)
+
+    locations = []
+    for count, x, y in zip(counts, sum_x, sum_y):
+        if count >= max(1, minimum_pixels):
+            locations.append((int(x / count), int(y / count)))
+        else:
+            locations.append((-1, -1))  # Nothing decoded for this LED
+    return locations
+
+
+def get_brightest_level(gray_image, ignore_pixels=2):
+    # Highest grey level in the image, ignoring a couple of hot pixels
+    histogram = np.bincount(gray_image.ravel(), minlength=256)
+    pixels_at_or_above = np.cumsum(histogram[::-1])
+    return 255 - int(np.argmax(pixels_at_or_above > ignore_pixels))
+
+
+def is_single_compact_blob(gray_image, threshold, maximum_blob_area):
+    # The single LED detection wants exactly one small blob above the threshold,
+    # not a reflection next to the LED or a big bloom
+    count, _, stats, _ = cv.connectedComponentsWithStats(
+        create_threshold(gray_image, threshold)
+    )
+    return count == 2 and stats[1, cv.CC_STAT_AREA] <= maximum_blob_area
+
+
+def pick_calibration(off_gray_image, on_frames, maximum_blob_area=400):
+    # on_frames maps each tried brightness to BGR frames of single lit LEDs.
+    # For every brightness the threshold goes halfway between the brightest level
+    # with all LEDs off and the dimmest of the lit LEDs' peaks. LEDs that don't rise
+    # above the off level, like one hidden from the camera, are left out of that, so
+    # they can't pull the threshold down for all the others. The brightness that
+    # gives the most single, compact blobs wins, then the widest gap.
+    # Returns (brightness, threshold, LEDs seen as a single blob, gap) per brightness,
+    # best first.
+    off_level = get_brightest_level(off_gray_image)
+    results = []
+    for brightness, frames in on_frames.items():
+        gray_images = [cv.cvtColor(frame, cv.COLOR_BGR2GRAY) for frame in frames]
+        on_levels = [
+            level
+            for level in map(get_brightest_level, gray_images)
+            if level > off_level
+        ]
+        gap = min(on_levels) - off_level if on_levels else 0
+        # create_threshold keeps pixels above threshold + 1
+        threshold = min(254, max(0, off_level + gap // 2 - 1))
+        single_blobs = 0
+        if gap > 0:
+            for gray_image in gray_images:
+                single_blobs += is_single_compact_blob(
+                    gray_image, threshold, maximum_blob_area
+                )
+        results.append((brightness, threshold, single_blobs, gap))
+    results.sort(key=lambda result: (result[2], result[3]), reverse=True)
+    return results
+
+
+class CameraSession(threading.Thread):
+    # Keeps one camera open for the whole run. A grabber thread reads frames as fast as
+    # the camera delivers them and keeps only the newest one with the time it arrived,
+    # so nobody gets a stale frame that sat in the driver's buffer. read() works like
+    # cv.VideoCapture.read(), so the session can be used wherever a camera is.
+    def __init__(self, camera_id: int) -> None:
+        super().__init__(name="camera-" + str(camera_id), daemon=True)
+        self.camera_id = camera_id
+        self._vc = open_camera(camera_id)
+        self._device_lock = threading.Lock()
+        self._new_frame = threading.Condition()
+        self._frame = None
+        self._timestamp = 0.0
+        self._frame_number = 0
+        self._frame_number_read = 0
+        self.last_timestamp = 0.0  # When the frame read() returned last arrived
+        self._running = True
+
+    def run(self) -> None:
+        while self._running:
+            with self._device_lock:
+                success, frame = self._vc.read()
+            if not success:
+                print("Camera", self.camera_id, "stopped delivering frames")
+                frame = None
+            with self._new_frame:
+                self._frame = frame
+                self._timestamp = time.monotonic()
+                self._frame_number += 1
+                self._new_frame.notify_all()
+            if frame is None:
+                break
+
+    def read(self, timeout: float = 1.0):
+        # The newest frame that arrived since the last read, waiting for one if needed
+        with self._new_frame:
+            self._new_frame.wait_for(
+                lambda: self._frame_number > self._frame_number_read
+                or not self.is_alive(),
+                timeout,
+            )
+            if self._frame_number == self._frame_number_read or self._frame is None:
+                return False, None
+            self._frame_number_read = self._frame_number
+            self.last_timestamp = self._timestamp
+            return True, self._frame
+
+    def get_frame_after(self, timestamp: float, timeout: float = 1.0):
+        # The first frame that arrived at or after timestamp, or None on timeout
+        with self._new_frame:
+            arrived = self._new_frame.wait_for(
+                lambda: self._timestamp >= timestamp or not self.is_alive(), timeout
+            )
+            if not arrived or self._timestamp < timestamp:
+                return None
+            return self._frame
+
+    def lock_exposure(self) -> bool:
+        # Keeps the camera from re-adjusting to every LED that turns on or off.
+        # Auto exposure values differ between backends: 0.25 is manual for V4L2,
+        # 1 for DirectShow and others. Returns whether the camera accepted it.
+        with self._device_lock:
+            exposure = self._vc.get(cv.CAP_PROP_EXPOSURE)
+            gain = self._vc.get(cv.CAP_PROP_GAIN)
+            locked = self._vc.set(cv.CAP_PROP_AUTO_EXPOSURE, 0.25) or self._vc.set(
+                cv.CAP_PROP_AUTO_EXPOSURE, 1
+            )
+            self._vc.set(cv.CAP_PROP_EXPOSURE, exposure)
+            self._vc.set(cv.CAP_PROP_GAIN, gain)
+            self._vc.set(cv.CAP_PROP_AUTO_WB, 0)
+        print("Camera exposure locked" if locked else "Camera can't lock exposure")
+        return locked
+
+    def publish(self, shared_frame: SharedFrame, stop_event) -> None:
+        # Copies frames into shared memory for another process until stop_event is set
+        while not stop_event.is_set():
+            success, frame = self.read()
+            if success:
+                shared_frame.write(frame)
+
+    def close(self) -> None:
+        self._running = False
+        self.join()
+        self._vc.release()
+
+
+SESSIONS: dict[int, CameraSession] = {}
+SESSIONS_LOCK = threading.Lock()
+
+
+def get_camera_session(camera_id: int) -> CameraSession:
+    with SESSIONS_LOCK:
+        session = SESSIONS.get(camera_id)
+        if session is None or not session.is_alive():
+            session = CameraSession(camera_id)
+            session.start()
+            SESSIONS[camera_id] = session
+        return session
+
+
+def close_camera_sessions() -> None:
+    with SESSIONS_LOCK:
+        for session in SESSIONS.values():
+            session.close()
+        SESSIONS.clear()
+
+
+class SharedFrame:
+    # The newest camera frame in one fixed-size shared-memory buffer, so the
+    # calibration process can show what the main process's camera session sees
+    # without opening the camera a second time.
+    def __init__(self, shape: tuple[int, ...]) -> None:
+        self.shape = shape
+        self._buffer = mp.RawArray("B", int(np.prod(shape)))
+        self._version = mp.Value("i", 0)  # Also guards the buffer
+
+    def write(self, frame) -> None:
+        with self._version.get_lock():
+            np.frombuffer(self._buffer, dtype=np.uint8).reshape(self.shape)[:] = frame
+            self._version.value += 1
+
+    def read(self):
+        # A copy of the newest frame, or None before the first write
+        with self._version.get_lock():
+            if not self._version.value:
+                return None
+            frame = np.frombuffer(self._buffer, dtype=np.uint8).reshape(self.shape)
+            return frame.copy()
+
+
+class CalibrationState:
+    # The latest (brightness, threshold) from the calibration process, kept in one
+    # fixed-size shared-memory slot. Writers overwrite it, so memory stays flat no
+    # matter how long calibration runs, and readers get notified when it changes.
+    def __init__(self) -> None:
+        self._values = mp.Array("i", 3)  # version, brightness, threshold
+        self._changed = mp.Event()
+
+    @property
+    def version(self) -> int:
+        return self._values[0]
+
+    def set(self, brightness: int, threshold: int) -> None:
+        with self._values.get_lock():
+            if self._values[0] and self._values[1:] == [brightness, threshold]:
+                return
+            self._values[0] += 1
+            self._values[1] = brightness
+            self._values[2] = threshold
+        self._changed.set()
+
+    def get(self) -> tuple[int, int] | tuple[None, None]:
+        with self._values.get_lock():
+            version, brightness, threshold = self._values[:]
+        if not version:
+            return None, None
+        return brightness, threshold
+
+    async def wait_for_change(
+        self, seen_version: int, timeout: float | None = None
+    ) -> bool:
+        # The blocking wait runs in a thread, so the event loop keeps going meanwhile.
+        # Short waits keep the thread from outliving a cancelled task for long.
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self.version == seen_version:
+            self._changed.clear()
+            if self.version != seen_version:
+                break
+            wait = 0.5 if deadline is None else min(0.5, deadline - loop.time())
+            if wait <= 0:
+                return False
+            await asyncio.to_thread(self._changed.wait, wait)
+        return True
+
+
 # CV is old and doesn't understand asyncio. This is likely where you're locking up.
-# So we spawn another python interpreter and pipe the results back.
+# So we spawn another python interpreter and share the results back.
 class LaunchCalibrationWindowProc(mp.Process):
-    def __init__(self, camera_id: int) -> None:
+    # With a shared_frame the frames come from the main process's camera session,
+    # otherwise the process opens the camera itself
+    def __init__(self, camera_id: int, shared_frame: SharedFrame | None = None) -> None:
         super().__init__(name="camera-calibration-proc")
         self._camera_id = camera_id
-        self.output: mp.Queue[tuple[int, int]] = mp.Queue()
+        self._shared_frame = shared_frame
+        self.output = CalibrationState()
         self.stop_event = mp.Event()
-        self.brightness: int | None = None
-        self.threshold: int | None = None
 
     @property
     def result(self) -> tuple[int, int] | tuple[None, None]:
-        try:
-            # Burn down the whole queue to get the last values.
-            while True:
-                self.brightness, self.threshold = self.output.get_nowait()
-        except queue.Empty:
-            return self.brightness, self.threshold
-
-    # Wrap up a queue monitor in a nice, async bow.
+        return self.output.get()
+
     async def get_results(self) -> tuple[int, int] | tuple[None, None]:
-        result = None
-        while not self.stop_event.is_set():
-            try:
-                # Inner while loop to burn down the queue again.
-                while True:
-                    result = self.output.get_nowait()
-            except queue.Empty:
-                await asyncio.sleep(0.050)
-        if result is not None:
-            self.brightness, self.threshold = result
-        return self.brightness, self.threshold
+        await asyncio.to_thread(self.stop_event.wait)
+        return self.output.get()
 
     def run(self) -> None:
         window_name = "Camera Calibration"
@@ -119,19 +611,26 @@ class LaunchCalibrationWindowProc(mp.Process):
         cv.createTrackbar("Threshold", window_name, 230, 255, do_nothing)
         cv.createTrackbar("LED_Brightness", window_name, 128, 255, do_nothing)
 
-        vc = open_camera(self._camera_id)
+        vc = None
+        if self._shared_frame is None:
+            vc = open_camera(self._camera_id)
         print("Calibration window is opened")
 
         while True:
-            success, frame = vc.read()
-            if not success:
-                print("Couldn't get frame, exiting")
-                break
+            if vc is None:
+                frame = self._shared_frame.read()
+                if frame is None:
+                    cv.waitKey(20)  # No frame from the camera session yet
+                    continue
+            else:
+                success, frame = vc.read()
+                if not success:
+                    print("Couldn't get frame, exiting")
+                    break
 
             brightness = cv.getTrackbarPos("LED_Brightness", window_name)
             threshold = cv.getTrackbarPos("Threshold", window_name)
-            # N.B. this queue is unbounded, don't leave the calibration window open overnight!
-            self.output.put((brightness, threshold))
+            self.output.set(brightness, threshold)
 
             _, contour_image, gray_image = get_led_position(frame, threshold)
             gray_image = overlay_text(gray_image)
@@ -145,7 +644,8 @@ class LaunchCalibrationWindowProc(mp.Process):
 
         print("Destroying calibration windows")
         cv.destroyAllWindows()
-        vc.release()
+        if vc is not None:
+            vc.release()
         self.stop_event.set()
 
 
@@ -205,7 +705,8 @@ def draw_all_led_positions(locations, image):
 
 
 def get_frame(vc):
-    success, frame = vc.read()
+    with timing.span("camera.read"):
+        success, frame = vc.read()
     if not success:
         print("Couldn't get frame, exiting")
         return None
@@ -213,19 +714,18 @@ def get_frame(vc):
     return frame
 
 
-def generate_output_image(camera_id, locations, name):
+def generate_output_image(camera_id, locations, name, output_dir="out"):
     print("Creating output image")
-    vc = cv.VideoCapture(camera_id)
-    if not vc.isOpened():  # try to get the first frame
-        print("Can't open camera")
-        vc.release()
-        exit()
-    success, frame = vc.read()
+    success, frame = get_camera_session(camera_id).read()
     if not success:
         print("Couldn't get frame, exiting")
         return
+    save_output_image(frame, locations, name, output_dir)
+
+
+def save_output_image(frame, locations, name, output_dir="out"):
     img = draw_all_led_positions(locations, frame)
-    status = cv.imwrite("out/" + name + ".png", img)
+    status = cv.imwrite(output_dir + "/" + name + ".png", img)
     print("Image of LED locations saved: ", status)
     if status:
-        os.system("start out/" + name + ".png")
+        os.system("start " + output_dir + "/" + name + ".png")
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import os
+import struct
+
+# One fixed-size record per detected LED: index, x, y, flags
+RECORD = struct.Struct("<iiiB")
+FLAG_OUTLIER = 1
+
+
+def get_checkpoint_path(output_dir="out"):
+    return output_dir + "/checkpoint.bin"
+
+
+def open_checkpoint(path, resume=False):
+    # Starting a fresh run throws the old checkpoint away
+    if not resume or not os.path.exists(path):
+        return open(path, "wb")
+    checkpoint_file = open(path, "r+b")
+    # Drop a record cut short by a crash, so new records line up again
+    size = checkpoint_file.seek(0, os.SEEK_END)
+    checkpoint_file.truncate(size - size % RECORD.size)
+    checkpoint_file.seek(0, os.SEEK_END)
+    return checkpoint_file
+
+
+def append_checkpoint(checkpoint_file, i, location, flags=0):
+    checkpoint_file.write(RECORD.pack(i, location[0], location[1], flags))
+    checkpoint_file.flush()  # Survive the process dying on the next LED
+
+
+def load_checkpoint(path) -> dict[int, tuple[tuple[int, int], int]]:
+    # Later records for the same LED replace earlier ones, so re-mapped LEDs win
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, "rb") as checkpoint_file:
+        data = checkpoint_file.read()
+    # A record cut short by a crash is ignored
+    usable = len(data) - len(data) % RECORD.size
+    for i, x, y, flags in RECORD.iter_unpack(data[:usable]):
+        records[i] = ((x, y), flags)
+    return records
+
+
+def get_resume_index(records):
+    i = 0
+    while i in records:
+        i += 1
+    return i
+
+
+def get_leds_to_remap(records, num_leds):
+    return [
+        i
+        for i in range(num_leds)
+        if i not in records
+        or records[i][0] == (-1, -1)
+        or records[i][1] & FLAG_OUTLIER
+    ]
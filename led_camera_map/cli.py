@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# led-camera-map calibrate | map | quantize | upload | apply
+#
+# Every subcommand imports only what it needs, so the commands that don't use the
+# camera or the LEDs start without loading OpenCV or pyartnet.
+from __future__ import annotations
+
+import argparse
+import sys
+
+
+def configure_mapping(args):
+    from led_camera_map import mapping
+
+    mapping.WLED_IP = args.wled_ip[0]
+    mapping.CAMERA_ID = args.camera_id
+    mapping.LED_MAP_OUTPUT_NAME = args.name
+    mapping.LED_TRANSPORT = args.transport
+    return mapping
+
+
+def run_calibrate(args):
+    import asyncio
+
+    from led_camera_map import camera, led_control_wled
+
+    mapping = configure_mapping(args)
+    mapping.AUTO_CALIBRATION = args.auto
+    num_leds = args.leds or led_control_wled.get_led_count(mapping.WLED_IP)
+    try:
+        brightness, threshold = asyncio.run(
+            mapping.get_calibration(mapping.WLED_IP, num_leds)
+        )
+    finally:
+        camera.close_camera_sessions()
+    print("brightness", brightness, "threshold", threshold)
+    return 0
+
+
+def run_map(args):
+    import asyncio
+    import os
+
+    from led_camera_map import camera, led_control_wled, timing
+
+    mapping = configure_mapping(args)
+    mapping.MAPPING_MODE = args.mode
+    mapping.CHECKPOINT_MODE = args.checkpoint
+    mapping.AUTO_CALIBRATION = args.brightness is None and args.auto_calibrate
+    mapping.LEDMAP_WIDTH = args.width
+    mapping.LEDMAP_HEIGHT = args.height
+    mapping.LEDMAP_MAX_CELLS = args.max_cells
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    async def map_controller():
+        num_leds = args.leds
+        if args.prepare:
+            # Flash the LEDs in strip order, whatever map WLED currently uses
+            num_leds = await mapping.prepare_controller(
+                mapping.WLED_IP, args.output_dir
+            )
+        elif num_leds is None:
+            num_leds = led_control_wled.get_led_count(mapping.WLED_IP)
+        brightness, threshold = args.brightness, args.threshold
+        if brightness is None or threshold is None:
+            brightness, threshold = await mapping.get_calibration(
+                mapping.WLED_IP, num_leds
+            )
+        locations = await mapping.map_leds(
+            brightness, threshold, num_leds, mapping.WLED_IP, args.output_dir
+        )
+        return mapping.create_ledmap(locations, args.output_dir)
+
+    if args.timing:
+        timing.enable()
+    try:
+        width, height = asyncio.run(map_controller())
+    finally:
+        camera.close_camera_sessions()
+        if args.timing:
+            timing.print_summary()
+            timing.export_chrome_trace(args.output_dir + "/timing_trace.json")
+    print("Saved", args.name, "with width", width, "and height", height)
+    return 0
+
+
+def load_locations(path):
+    import json
+
+    from led_camera_map import checkpoint
+
+    if path.endswith(".bin"):
+        records = checkpoint.load_checkpoint(path)
+        num_leds = max(records, default=-1) + 1
+        return [records[i][0] if i in records else (-1, -1) for i in range(num_leds)]
+    with open(path, encoding="utf-8") as locations_file:
+        return [tuple(location) for location in json.load(locations_file)]
+
+
+def run_quantize(args):
+    from led_camera_map import checkpoint, format_map
+
+    locations = load_locations(
+        args.locations or checkpoint.get_checkpoint_path(args.output_dir)
+    )
+    values, width, height = format_map.build_2d_map(
+        locations, args.width, args.height, args.max_cells
+    )
+    format_map.save_wled_json(args.name, values, width, height, args.output_dir)
+    return 0
+
+
+def for_each_controller(args, function):
+    # Controllers are independent, so all of them are talked to at the same time
+    from concurrent.futures import ThreadPoolExecutor
+
+    import requests
+
+    def run_for_controller(wled_ip):
+        # One unreachable or failing controller mustn't stop the others' summary
+        try:
+            return function(wled_ip)
+        except (requests.RequestException, AssertionError) as error:
+            print("Error talking to", wled_ip + ":", repr(error))
+            return False
+
+    with ThreadPoolExecutor(len(args.wled_ip)) as pool:
+        results = list(pool.map(run_for_controller, args.wled_ip))
+    failed = [ip for ip, ok in zip(args.wled_ip, results) if not ok]
+    if failed:
+        print("Failed for", ", ".join(failed))
+        return 1
+    return 0
+
+
+def run_upload(args):
+    from led_camera_map import led_control_wled
+
+    def upload(wled_ip):
+        response = led_control_wled.upload_ledmap(
+            wled_ip, args.name, args.output_dir
+        )
+        return response.status_code == 200
+
+    return for_each_controller(args, upload)
+
+
+def run_apply(args):
+    import json
+
+    from led_camera_map import led_control_wled
+
+    ledmap_path = args.output_dir + "/" + args.name + ".json"
+    with open(ledmap_path, encoding="utf-8") as ledmap_file:
+        ledmap_json = json.load(ledmap_file)
+
+    def apply(wled_ip):
+        ledmap_id = led_control_wled.apply_ledmap(
+            wled_ip, args.name, args.output_dir
+        )
+        if ledmap_id is None:
+            return False
+        if args.segment:
+            led_control_wled.set_2d_segment(
+                wled_ip, ledmap_json["width"], ledmap_json["height"], ledmap_id
+            )
+        return True
+
+    return for_each_controller(args, apply)
+
+
+def add_map_size_arguments(parser):
+    parser.add_argument("--width", type=int, help="Snap onto a grid this wide")
+    parser.add_argument("--height", type=int, help="Snap onto a grid this high")
+    parser.add_argument(
+        "--max-cells", type=int, help="Snap onto at most this many cells"
+    )
+
+
+def get_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--wled-ip",
+        action="append",
+        help="WLED address, repeat it to upload or apply to several controllers",
+    )
+    common.add_argument("--name", default="ledmap2", help="ledmap1 to ledmap9")
+    common.add_argument("--output-dir", default="out")
+
+    led_options = argparse.ArgumentParser(add_help=False)
+    led_options.add_argument("--camera-id", type=int, default=0)
+    led_options.add_argument(
+        "--transport", choices=("artnet", "ddp"), default="artnet"
+    )
+    led_options.add_argument("--leds", type=int, help="Defaults to WLED's LED count")
+
+    parser = argparse.ArgumentParser(
+        prog="led-camera-map", description="Map WLED LEDs with a camera"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    calibrate = subparsers.add_parser(
+        "calibrate",
+        parents=[common, led_options],
+        help="Find the LED brightness and camera threshold",
+    )
+    calibrate.add_argument(
+        "--auto", action="store_true", help="Sweep brightnesses instead of the window"
+    )
+    calibrate.set_defaults(function=run_calibrate)
+
+    map_parser = subparsers.add_parser(
+        "map",
+        parents=[common, led_options],
+        help="Flash the LEDs, find them in the camera and save a ledmap",
+    )
+    map_parser.add_argument("--brightness", type=int)
+    map_parser.add_argument("--threshold", type=int)
+    map_parser.add_argument(
+        "--auto-calibrate",
+        action="store_true",
+        help="Without --brightness, sweep brightnesses instead of the window",
+    )
+    map_parser.add_argument(
+        "--mode", choices=("single", "gray_code", "rgb"), default="single"
+    )
+    map_parser.add_argument("--checkpoint", choices=("resume", "remap"))
+    map_parser.add_argument(
+        "--no-prepare",
+        dest="prepare",
+        action="store_false",
+        help="Don't switch WLED to a linear ledmap and segment first",
+    )
+    map_parser.add_argument("--timing", action="store_true")
+    add_map_size_arguments(map_parser)
+    map_parser.set_defaults(function=run_map)
+
+    quantize = subparsers.add_parser(
+        "quantize",
+        parents=[common],
+        help="Turn saved LED locations into a ledmap",
+    )
+    quantize.add_argument(
+        "--locations",
+        help="checkpoint.bin or a JSON list of [x, y], defaults to the checkpoint",
+    )
+    add_map_size_arguments(quantize)
+    quantize.set_defaults(function=run_quantize)
+
+    upload = subparsers.add_parser(
+        "upload", parents=[common], help="Upload a saved ledmap to WLED"
+    )
+    upload.set_defaults(function=run_upload)
+
+    apply = subparsers.add_parser(
+        "apply",
+        parents=[common],
+        help="Upload a saved ledmap if it changed and switch WLED to it",
+    )
+    apply.add_argument(
+        "--no-segment",
+        dest="segment",
+        action="store_false",
+        help="Keep WLED's segment instead of sizing it to the ledmap",
+    )
+    apply.set_defaults(function=run_apply)
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.command != "quantize" and not args.wled_ip:
+        parser.error("give the WLED address with --wled-ip")
+    if args.command in ("calibrate", "map") and len(args.wled_ip) > 1:
+        # They share the camera, run them one after the other with their own
+        # --output-dir instead
+        parser.error("calibrate and map take one --wled-ip at a time")
+    return args.function(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
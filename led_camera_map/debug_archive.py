@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Debug crops of every detected LED, kept in one preallocated memory-mapped array
+# instead of one PNG per LED. Page through them with:
+#
+#   python -m led_camera_map.debug_archive out/debug_crops
+from __future__ import annotations
+
+import argparse
+import os
+import queue
+import threading
+
+import cv2 as cv
+import numpy as np
+
+from led_camera_map import timing
+
+CROPS_FILE = "crops.npy"
+INDEX_FILE = "index.npy"
+CROP_SIZE = 64
+# One index row per slot: LED index (-1 while empty), detected x and y, and the crop's
+# top left corner in the frame. The corner is (-1, -1) when nothing was detected and
+# the slot holds the whole frame scaled down instead.
+INDEX_COLUMNS = 5
+
+
+def get_debug_archive_dir(output_dir="out"):
+    return output_dir + "/debug_crops"
+
+
+def crop_around(frame, location, crop_size=CROP_SIZE):
+    if location == (-1, -1):
+        crop = cv.resize(frame, (crop_size, crop_size), interpolation=cv.INTER_AREA)
+        return crop, (-1, -1)
+    height, width = frame.shape[:2]
+    x0 = min(max(0, location[0] - crop_size // 2), max(0, width - crop_size))
+    y0 = min(max(0, location[1] - crop_size // 2), max(0, height - crop_size))
+    crop = np.zeros((crop_size, crop_size, 3), dtype=np.uint8)
+    window = frame[y0 : y0 + crop_size, x0 : x0 + crop_size]
+    crop[: window.shape[0], : window.shape[1]] = window
+    return crop, (x0, y0)
+
+
+def open_archive(path, num_slots, crop_size=CROP_SIZE, resume=False):
+    # Resuming keeps the crops of LEDs that aren't flashed again
+    os.makedirs(path, exist_ok=True)
+    crops_path = path + "/" + CROPS_FILE
+    index_path = path + "/" + INDEX_FILE
+    if resume and os.path.exists(crops_path) and os.path.exists(index_path):
+        crops = np.load(crops_path, mmap_mode="r+")
+        index = np.load(index_path, mmap_mode="r+")
+        if crops.shape == (num_slots, crop_size, crop_size, 3):
+            return crops, index
+    crops = np.lib.format.open_memmap(
+        crops_path,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(num_slots, crop_size, crop_size, 3),
+    )
+    index = np.lib.format.open_memmap(
+        index_path, mode="w+", dtype=np.int32, shape=(num_slots, INDEX_COLUMNS)
+    )
+    index[:, 0] = -1
+    return crops, index
+
+
+class CropArchiveWriter(threading.Thread):
+    # Crops and stores debug images off the capture path. Slot i holds LED i, so
+    # re-mapping an LED overwrites its old crop. The queue is bounded so a slow disk
+    # slows the producer down instead of piling up frames in memory.
+    def __init__(
+        self, path, num_slots, crop_size=CROP_SIZE, resume=False, max_pending=16
+    ) -> None:
+        super().__init__(name="crop-archive-writer", daemon=True)
+        self._crops, self._index = open_archive(path, num_slots, crop_size, resume)
+        self._crop_size = crop_size
+        self._queue: queue.Queue[tuple[int, object, tuple[int, int]] | None] = (
+            queue.Queue(max_pending)
+        )
+        self._error: Exception | None = None
+
+    def save(self, led: int, frame, location: tuple[int, int]) -> None:
+        self._queue.put((led, frame, location))
+
+    def run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue  # Keep draining, so save() never blocks on a full queue
+            led, frame, location = item
+            try:
+                with timing.span("debug.crop", led=led):
+                    crop, origin = crop_around(frame, location, self._crop_size)
+                    self._crops[led] = crop
+                    self._index[led] = (led, *location, *origin)
+            except Exception as error:
+                print("Storing the debug crop of LED", led, "failed:", repr(error))
+                self._error = error
+
+    def close(self) -> None:
+        # Raises the first error of the writer thread, once the capture is done
+        self._queue.put(None)
+        self.join()
+        self._crops.flush()
+        self._index.flush()
+        if self._error is not None:
+            raise self._error
+
+
+def draw_page(crops, index, slots, columns, scale):
+    # Only the crops on this page are read from the memory-mapped file
+    cell_size = crops.shape[1] * scale
+    rows = -(-len(slots) // columns)
+    page = np.zeros((rows * cell_size, columns * cell_size, 3), dtype=np.uint8)
+    for position, slot in enumerate(slots):
+        row, column = divmod(position, columns)
+        cell = cv.resize(
+            np.asarray(crops[slot]),
+            (cell_size, cell_size),
+            interpolation=cv.INTER_NEAREST,
+        )
+        led, x, y, x0, y0 = (int(value) for value in index[slot])
+        if x0 != -1:
+            centre = ((x - x0) * scale, (y - y0) * scale)
+            cv.drawMarker(cell, centre, (0, 0, 255), cv.MARKER_CROSS, 12, 1)
+        label = str(led) if x0 != -1 else str(led) + " missing"
+        cv.putText(
+            cell, label, (3, 14), cv.FONT_HERSHEY_SIMPLEX, 0.45, (0, 255, 0), 1
+        )
+        page[
+            row * cell_size : (row + 1) * cell_size,
+            column * cell_size : (column + 1) * cell_size,
+        ] = cell
+    return page
+
+
+def view_archive(path, columns=8, rows=6, scale=2, missing_only=False):
+    crops = np.load(path + "/" + CROPS_FILE, mmap_mode="r")
+    index = np.load(path + "/" + INDEX_FILE, mmap_mode="r")
+    slots = np.flatnonzero(index[:, 0] != -1)
+    if missing_only:
+        slots = slots[index[slots, 3] == -1]
+    if len(slots) == 0:
+        print("No crops to show in", path)
+        return
+    per_page = columns * rows
+    pages = -(-len(slots) // per_page)
+    page_number = 0
+    window_name = "LED debug crops"
+    print("n / space: next page, p / backspace: previous page, Esc / q: quit")
+    while True:
+        page_slots = slots[page_number * per_page : (page_number + 1) * per_page]
+        cv.imshow(window_name, draw_page(crops, index, page_slots, columns, scale))
+        cv.setWindowTitle(
+            window_name, f"LED debug crops, page {page_number + 1} of {pages}"
+        )
+        key = cv.waitKey(0) & 0xFF
+        if key in (27, ord("q")):
+            break
+        if key in (ord("n"), ord(" ")):
+            page_number = min(pages - 1, page_number + 1)
+        elif key in (ord("p"), 8):
+            page_number = max(0, page_number - 1)
+    cv.destroyAllWindows()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Page through the LED debug crops")
+    parser.add_argument("archive", nargs="?", default=get_debug_archive_dir())
+    parser.add_argument("--columns", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=6)
+    parser.add_argument("--scale", type=int, default=2)
+    parser.add_argument(
+        "--missing", action="store_true", help="Only show LEDs that weren't found"
+    )
+    args = parser.parse_args()
+    view_archive(args.archive, args.columns, args.rows, args.scale, args.missing)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,25 @@
 import json
+import math
+import numpy as np
 
 
 def flatten_2d_map(positions: list[tuple[int, int]]):
-    # This method also removes all empty rows or columns to compress the grid
+    # This method also removes all empty rows or columns to compress the grid.
+    # WLED reads the map row by row: entry row * width + column.
     rows = set()
     cols = set()
     mymap = dict()
     for i, (x, y) in enumerate(positions):
+        if x == -1 and y == -1:
+            continue  # Not found or excluded, so not in the map
         rows.add(y)
         cols.add(x)
         col = mymap.get(x, dict())
         col[y] = i
         mymap[x] = col
     values = []
-    for col in sorted(list(cols)):
-        for row in sorted(list(rows)):
+    for row in sorted(list(rows)):
+        for col in sorted(list(cols)):
             values.append(mymap.get(col, dict()).get(row, -1))
     width = len(cols)
     height = len(rows)
@@ -31,8 +36,247 @@ def flatten_2d_map(positions: list[tuple[int, int]]):
     return values, width, height
 
 
-def generate_basic_ledmap(num_leds):
-    save_wled_json("ledmap0", list(range(num_leds)), num_leds, 1)
+def get_quantized_grid_size(span_x, span_y, width=None, height=None, max_cells=None):
+    aspect = (span_x + 1) / (span_y + 1)
+    if width is None and height is None:
+        # Biggest grid with the camera's aspect ratio that stays under max_cells
+        width = max(1, int(math.sqrt(max_cells * aspect)))
+        height = max(1, max_cells // width)
+    elif height is None:
+        height = max(1, round(width / aspect))
+    elif width is None:
+        width = max(1, round(height * aspect))
+    if max_cells is not None:
+        while width * height > max_cells and max(width, height) > 1:
+            # A dimension that is already 1 can't shrink, even if it's the long one
+            if height == 1 or (width > 1 and width * span_y >= height * span_x):
+                width -= 1
+            else:
+                height -= 1
+    return width, height
+
+
+def find_nearest_free_cell(occupied, col, row):
+    # Search square rings around the cell, nearest first, ties broken by column then row
+    width, height = occupied.shape
+    for radius in range(1, max(width, height)):
+        candidates = []
+        for c in range(max(0, col - radius), min(width, col + radius + 1)):
+            for r in range(max(0, row - radius), min(height, row + radius + 1)):
+                if max(abs(c - col), abs(r - row)) == radius and not occupied[c, r]:
+                    candidates.append(((c - col) ** 2 + (r - row) ** 2, c, r))
+        if candidates:
+            _, c, r = min(candidates)
+            return c, r
+    return None
+
+
+def get_flat_cells(positions: list[tuple[int, int]]):
+    # Every LED's (column, row) in the grid flatten_2d_map builds, worked out from the
+    # positions alone. LEDs at (-1, -1) and LEDs that a later LED in the same spot
+    # overwrites get (-1, -1).
+    points = np.array(positions, dtype=np.int64).reshape(-1, 2)
+    cells = np.full(points.shape, -1, dtype=np.int64)
+    led_ids = np.flatnonzero((points != -1).any(axis=1))
+    if len(led_ids) == 0:
+        return cells
+    _, cols = np.unique(points[led_ids, 0], return_inverse=True)
+    _, rows = np.unique(points[led_ids, 1], return_inverse=True)
+    last_in_cell = {}
+    for i, cell in zip(led_ids.tolist(), zip(cols.tolist(), rows.tolist())):
+        last_in_cell[cell] = i
+    kept = np.array(list(last_in_cell.values()), dtype=np.int64)
+    cells[kept] = np.array(list(last_in_cell.keys()), dtype=np.int64)
+    return cells
+
+
+def get_quantized_cells(
+    positions: list[tuple[int, int]], width=None, height=None, max_cells=None
+):
+    # Every LED's (column, row) on the quantized grid, (-1, -1) for LEDs that weren't
+    # found or didn't fit. Returns the cells, the grid size and how many LEDs were
+    # moved to another cell or didn't fit.
+    points = np.array(positions, dtype=np.float64).reshape(-1, 2)
+    cells = np.full(points.shape, -1, dtype=np.int64)
+    led_ids = np.flatnonzero((points != -1).any(axis=1))
+    points = points[led_ids]
+    if len(led_ids) == 0:
+        return cells, 0, 0, 0, 0
+
+    minimum = points.min(axis=0)
+    span_x, span_y = points.max(axis=0) - minimum
+    width, height = get_quantized_grid_size(span_x, span_y, width, height, max_cells)
+
+    scale = np.array([width - 1, height - 1]) / np.maximum([span_x, span_y], 1)
+    cells[led_ids], moved, dropped = place_in_grid(
+        led_ids, (points - minimum) * scale, width, height
+    )
+    return cells, width, height, moved, dropped
+
+
+def quantize_2d_map(
+    positions: list[tuple[int, int]], width=None, height=None, max_cells=None
+):
+    # Snaps camera coordinates onto a grid of a chosen size instead of using every
+    # pixel row/column, so the ledmap stays small enough for WLED to load.
+    # Produces the same row by row layout as flatten_2d_map.
+    if width is None and height is None and max_cells is None:
+        raise ValueError("Give a width, a height or a maximum number of cells")
+
+    cells, width, height, moved, dropped = get_quantized_cells(
+        positions, width, height, max_cells
+    )
+    found = int((cells != -1).all(axis=1).sum()) + dropped
+    if found == 0:
+        return [], 0, 0
+
+    print(
+        "Quantized",
+        found,
+        "LEDs onto a",
+        width,
+        "by",
+        height,
+        "grid of",
+        width * height,
+        "cells.",
+        moved,
+        "LEDs shared a cell and were moved to the nearest free one.",
+    )
+    if dropped:
+        print(dropped, "LEDs didn't fit into the grid and were left out")
+    return get_row_major_map(cells, width, height), width, height
+
+
+def build_2d_map(
+    positions: list[tuple[int, int]], width=None, height=None, max_cells=None
+):
+    # Keeps every distinct pixel row and column when no size is given, otherwise snaps
+    # the LEDs onto a grid of that size. Returns the map, its width and its height.
+    if width is None and height is None and max_cells is None:
+        return flatten_2d_map(positions)
+    return quantize_2d_map(positions, width, height, max_cells)
+
+
+def get_2d_map_cells(
+    positions: list[tuple[int, int]], width=None, height=None, max_cells=None
+):
+    # Every LED's (column, row) in the map build_2d_map makes from the same arguments
+    if width is None and height is None and max_cells is None:
+        return get_flat_cells(positions)
+    cells, _, _, _, _ = get_quantized_cells(positions, width, height, max_cells)
+    return cells
+
+
+def place_in_grid(led_ids, exact, width, height):
+    # exact holds each LED's (column, row) in grid units. Returns the cell every LED
+    # ended up in, (-1, -1) if it didn't fit, and how many LEDs were moved to another
+    # cell or didn't fit.
+    cells = np.rint(exact).astype(np.int64)
+    cols, rows = cells[:, 0], cells[:, 1]
+
+    # The LED closest to the centre of a cell keeps it, then the lowest LED id
+    distance = ((exact - cells) ** 2).sum(axis=1)
+    cell_ids = cols * height + rows
+    order = np.lexsort((led_ids, distance, cell_ids))
+    first_in_cell = np.ones(len(order), dtype=bool)
+    first_in_cell[1:] = cell_ids[order][1:] != cell_ids[order][:-1]
+
+    # Everyone else moves to the nearest free cell, in the same deterministic order
+    occupied = np.zeros((width, height), dtype=bool)
+    occupied[cols[order[first_in_cell]], rows[order[first_in_cell]]] = True
+    moved = 0
+    dropped = 0
+    for index in order[~first_in_cell]:
+        cell = find_nearest_free_cell(occupied, cols[index], rows[index])
+        if cell is None:
+            cells[index] = -1
+            dropped += 1
+            continue
+        occupied[cell] = True
+        cells[index] = cell
+        moved += 1
+    return cells, moved, dropped
+
+
+def get_row_major_map(cells, width, height):
+    # WLED reads the map row by row: entry row * width + column is the LED shown at
+    # (column, row). LED i is at cells[i], or nowhere if that's (-1, -1).
+    values = np.full(width * height, -1, dtype=np.int64)
+    led_ids = np.flatnonzero((cells != -1).all(axis=1))
+    values[cells[led_ids, 1] * width + cells[led_ids, 0]] = led_ids
+    return values
+
+
+AXES = {"x": 0, "y": 1, "z": 2}
+
+
+def project_3d_map(positions_3d, axes="xy", scale=1.0):
+    # Drops the third axis, so triangulated positions can go through flatten_2d_map
+    # or quantize_2d_map like camera positions. scale is grid units per world unit.
+    # LEDs without a position become (-1, -1).
+    first, second = AXES[axes[0]], AXES[axes[1]]
+    known = [position for position in positions_3d if position is not None]
+    if not known:
+        return [(-1, -1)] * len(positions_3d)
+    minimum = np.array(known).min(axis=0)
+    positions = []
+    for position in positions_3d:
+        if position is None:
+            positions.append((-1, -1))
+            continue
+        positions.append(
+            (
+                int(round((position[first] - minimum[first]) * scale)),
+                int(round((position[second] - minimum[second]) * scale)),
+            )
+        )
+    return positions
+
+
+def voxelize_3d_map(positions_3d, width, height, depth):
+    # Snaps triangulated positions into width x height x depth voxels. WLED ledmaps
+    # are 2D, so the depth layers are stacked below each other: the map is width
+    # columns by height * depth rows, with layer z in rows z * height and up.
+    if width is None or height is None or depth is None:
+        raise ValueError("Give a width, a height and a depth")
+    led_ids = np.array(
+        [i for i, position in enumerate(positions_3d) if position is not None],
+        dtype=np.int64,
+    )
+    if len(led_ids) == 0:
+        return [], 0, 0
+    points = np.array([positions_3d[i] for i in led_ids], dtype=np.float64)
+    minimum = points.min(axis=0)
+    span = np.maximum(points.max(axis=0) - minimum, 1e-9)
+    voxels = (points - minimum) / span * np.array([width - 1, height - 1, depth - 1])
+    layers = np.rint(voxels[:, 2])
+    exact = np.column_stack((voxels[:, 0], layers * height + voxels[:, 1]))
+    cells = np.full((len(positions_3d), 2), -1, dtype=np.int64)
+    cells[led_ids], moved, dropped = place_in_grid(
+        led_ids, exact, width, height * depth
+    )
+
+    print(
+        "Voxelized",
+        len(led_ids),
+        "LEDs into",
+        width,
+        "by",
+        height,
+        "by",
+        depth,
+        "voxels.",
+        moved,
+        "LEDs shared a voxel and were moved to the nearest free one.",
+    )
+    if dropped:
+        print(dropped, "LEDs didn't fit into the grid and were left out")
+    return get_row_major_map(cells, width, height * depth), width, height * depth
+
+
+def generate_basic_ledmap(num_leds, output_dir="out"):
+    save_wled_json("ledmap0", np.arange(num_leds), num_leds, 1, output_dir)
 
 
 def create_wled_json(ledmap_coordinates, width, height, name):
@@ -45,30 +289,61 @@ def create_wled_json(ledmap_coordinates, width, height, name):
     return ledmap
 
 
-def save_wled_json(name, ledmap, width, height):
-    ledmap_json = create_wled_json(ledmap, width, height, name)
+def save_wled_json(name, ledmap, width, height, output_dir="out"):
+    # Written one row of the map at a time, byte for byte what json.dump with
+    # separators=(",", ":") writes, without building the whole text first.
+    # The returned ledmap json holds the map as an integer array.
+    ledmap = np.asarray(ledmap, dtype=np.int64)
+    ledmap_path = output_dir + "/" + name + ".json"
+
+    print("Generated " + ledmap_path)
 
-    print("Generated out/" + name + ".json")
+    with open(ledmap_path, "w", encoding="utf8") as outfile:
+        outfile.write(
+            f'{{"n":{json.dumps(name)},"width":{width},"height":{height},"map":['
+        )
+        for start in range(0, len(ledmap), max(1, width)):
+            if start:
+                outfile.write(",")
+            outfile.write(",".join(map(str, ledmap[start : start + width].tolist())))
+        outfile.write("]}")
 
-    with open("out/" + name + ".json", "w", encoding="utf8") as outfile:
-        json.dump(ledmap_json, outfile, separators=(",", ":"))
+    return create_wled_json(ledmap, width, height, name)
 
-    return ledmap_json
 
+def shrink_ledmap_rows(rows, block_width):
+    # The lowest LED id in every block_width wide block of the rows, -1 if none
+    empty = np.iinfo(np.int64).max
+    rows = np.where(rows == -1, empty, rows)
+    lowest = np.minimum.reduceat(rows, range(0, rows.shape[1], block_width), axis=1)
+    lowest = lowest.min(axis=0)
+    return np.where(lowest == empty, -1, lowest)
 
-def visualize_ledmap(ledmap_json):
+
+def visualize_ledmap(ledmap_json, output_dir="out", max_columns=128, max_rows=128):
+    # Printed and saved one row at a time. Maps bigger than max_columns by max_rows
+    # are shrunk, every printed cell then shows the lowest LED id in its block.
     width = ledmap_json["width"]
-    ledmap = ledmap_json["map"]
-    ledmap[:] = [str(x) if x != -1 else "." for x in ledmap]  # Replace all "-1"
+    ledmap = np.asarray(ledmap_json["map"], dtype=np.int64)
+    if width < 1:
+        return
+    height = len(ledmap) // width
+    block_width = max(1, -(-width // max_columns))
+    block_height = max(1, -(-height // max_rows))
 
     column_width = 4  # How many characters wide each printed column is
 
-    n = int(len(ledmap) / width)
-    pat = "{{:{}}}".format(column_width)
-    line = "\n".join(pat * width for _ in range(n))
-    formatted_map = line.format(*ledmap)
     print(ledmap_json["n"], "looks like:")
-    print(formatted_map)
-
-    with open("out/map_visualization.txt", "w", encoding="utf-8") as text_file:
-        text_file.write(formatted_map)
+    if block_width > 1 or block_height > 1:
+        print("(shrunk, one cell per", block_width, "by", block_height, "cells)")
+    visualization_path = output_dir + "/map_visualization.txt"
+    with open(visualization_path, "w", encoding="utf-8") as text_file:
+        for row in range(0, height, block_height):
+            rows = ledmap[row * width : min(height, row + block_height) * width]
+            values = shrink_ledmap_rows(rows.reshape(-1, width), block_width)
+            line = "".join(
+                ("." if value == -1 else str(value)).ljust(column_width)
+                for value in values.tolist()
+            )
+            print(line)
+            text_file.write(line if row == 0 else "\n" + line)
@@ -2,75 +2,191 @@ from __future__ import annotations
 
 from typing import NoReturn
 import asyncio
+import time
 from pyartnet import ArtNetNode, Channel
 
-CHANNELS_PER_LED = 3
+from led_camera_map import led_control_ddp, timing
+from led_camera_map.led_frame_buffer import CHANNELS_PER_LED, WHITE, LedFrameBuffer
+
+CHANNELS_PER_UNIVERSE = 512
+LEDS_PER_UNIVERSE = CHANNELS_PER_UNIVERSE // CHANNELS_PER_LED  # 170 RGB LEDs
 WLED_TIMEOUT_MS = 2500
+SETTLE_TIME = 0.2  # Seconds to wait for an LED change when the camera isn't watching
+# Up to three LEDs can share a frame when each is lit in a different pure colour
+RGB_COLORS = ((255, 0, 0), (0, 255, 0), (0, 0, 255))
+
+
+def get_universe_count(num_leds: int) -> int:
+    return max(1, -(-num_leds // LEDS_PER_UNIVERSE))
+
+
+class ArtNetFrameBuffer(LedFrameBuffer):
+    # Spreads the LEDs over consecutive universes the way WLED's "Dimmer + Multi RGB"
+    # mode reads them: the first universe starts with the dimmer channel, then every
+    # universe holds up to 170 RGB LEDs. Each universe keeps one preallocated buffer
+    # and only universes that changed since the last send are handed to pyartnet.
+    def __init__(self, node: ArtNetNode, num_leds: int, start_universe: int = 0):
+        super().__init__(num_leds)
+        self._node = node
+        self._buffers: list[bytearray] = []
+        self._views: list[memoryview] = []
+        self._channels: list[Channel] = []
+        self._dirty: set[int] = set()
+
+        for index in range(get_universe_count(num_leds)):
+            leds_in_universe = min(
+                LEDS_PER_UNIVERSE, num_leds - index * LEDS_PER_UNIVERSE
+            )
+            width = leds_in_universe * CHANNELS_PER_LED
+            if index == 0:
+                width += 1  # Dimmer channel
+            buffer = bytearray(max(width, 1))
+            universe = node.add_universe(start_universe + index)
+            self._buffers.append(buffer)
+            self._views.append(memoryview(buffer))
+            self._channels.append(universe.add_channel(start=1, width=len(buffer)))
+
+    def _locate(self, position: int) -> tuple[int, int]:
+        index, led_in_universe = divmod(position, LEDS_PER_UNIVERSE)
+        offset = led_in_universe * CHANNELS_PER_LED
+        if index == 0:
+            offset += 1  # Skip the dimmer channel
+        return index, offset
+
+    def set_brightness(self, brightness: int):
+        if self._buffers[0][0] != brightness:
+            self._buffers[0][0] = brightness
+            self._dirty.add(0)
+
+    def set_led(self, position: int, color: tuple[int, int, int] = WHITE):
+        index, offset = self._locate(position)
+        self._buffers[index][offset : offset + CHANNELS_PER_LED] = bytes(color)
+        self._dirty.add(index)
+        super().set_led(position, color)
+
+    async def send(self):
+        with timing.span("artnet.send", universes=len(self._dirty)):
+            for index in sorted(self._dirty):
+                self._channels[index].set_values(self._views[index])
+        self._dirty.clear()
+        self.sent_at = time.monotonic()
+
+    def close(self):
+        # Otherwise the node keeps resending its universes every two seconds, over
+        # whatever a later run shows
+        self._node.stop_refresh()
+
+
+async def setup_artnet_leds(ip_address: str, num_leds: int) -> ArtNetFrameBuffer:
+    node = ArtNetNode(ip_address, 6454)
+    return ArtNetFrameBuffer(node, num_leds)
 
 
-def get_channel_width(num_leds: int):
-    return (num_leds * CHANNELS_PER_LED) + 1  # Assuming mode "Dimmer + Multi RGB"
+async def setup_leds(
+    ip_address: str, num_leds: int, transport: str = "artnet"
+) -> LedFrameBuffer:
+    # "artnet" needs WLED's ArtNet "Dimmer + Multi RGB" mode, "ddp" works as is
+    if transport == "ddp":
+        return await led_control_ddp.setup_ddp_leds(ip_address, num_leds)
+    return await setup_artnet_leds(ip_address, num_leds)
 
 
-async def setup_artnet_leds(ip_address: str, num_leds: int) -> Channel:
-    node = ArtNetNode(ip_address, 6454)
-    universe = node.add_universe(0)
-    return universe.add_channel(start=1, width=get_channel_width(num_leds))
+async def light_one_led(
+    frame_buffer: LedFrameBuffer,
+    i: int,
+    brightness: int,
+    settle_time: float = SETTLE_TIME,
+):
+    print("Lighting up LED ", i)
+    frame_buffer.show_only((i,), brightness)
+    await frame_buffer.send()
+    with timing.span("artnet.settle_sleep", led=i):
+        await asyncio.sleep(settle_time)
 
 
-def create_single_pixel_channel(
-    num_leds: int, position: int, brightness: int
-) -> list[int]:
-    array = [0] * get_channel_width(num_leds)
-    array[0] = (
-        brightness  # First entry in the array is the brightness of the whole array
-    )
-    start = 1 + position * CHANNELS_PER_LED
-    for i in range(start, start + CHANNELS_PER_LED):
-        array[i] = 255
-    return array
+async def light_rgb_leds(
+    frame_buffer: LedFrameBuffer,
+    positions,
+    brightness: int,
+    settle_time: float = SETTLE_TIME,
+):
+    # The first LED is lit red, the second green and the third blue
+    print("Lighting up LEDs ", *positions, " in red, green and blue")
+    frame_buffer.show_colors(dict(zip(positions, RGB_COLORS)), brightness)
+    await frame_buffer.send()
+    with timing.span("artnet.settle_sleep", led=positions[0]):
+        await asyncio.sleep(settle_time)
 
 
-async def light_one_led(channel: Channel, num_leds: int, i: int, brightness: int):
-    print("Lighting up LED ", i)
-    await channel.set_values(create_single_pixel_channel(num_leds, i, brightness))
-    await asyncio.sleep(0.2)
+def get_gray_code_bit_count(num_leds: int) -> int:
+    return max(1, (num_leds - 1).bit_length())
+
 
+def get_gray_code_positions(num_leds: int, bit: int, complement: bool) -> list[int]:
+    # Every LED whose gray-coded index has this bit set (or unset, for the complement)
+    return [
+        position
+        for position in range(num_leds)
+        if bool((position ^ (position >> 1)) >> bit & 1) != complement
+    ]
 
-async def flash_leds_in_order(ip_address, num_leds, brightness: int):
+
+async def light_gray_code_pattern(
+    frame_buffer: LedFrameBuffer,
+    bit: int,
+    complement: bool,
+    brightness: int,
+    settle_time: float = SETTLE_TIME,
+):
+    print("Lighting gray code bit ", bit, " (complement)" if complement else "")
+    frame_buffer.show_only(
+        get_gray_code_positions(frame_buffer.num_leds, bit, complement), brightness
+    )
+    await frame_buffer.send()
+    await asyncio.sleep(settle_time)
+
+
+async def flash_leds_in_order(
+    ip_address, num_leds, brightness: int, settle_time: float = 1, transport="artnet"
+):
     print("entering blink")
-    channel = await setup_artnet_leds(ip_address, num_leds)
+    frame_buffer = await setup_leds(ip_address, num_leds, transport)
     print("LEDs are ready")
     for i in range(num_leds):
         print("Lighting up pixel ", i)
-        channel.add_fade(create_single_pixel_channel(num_leds, i, brightness), 200)
-        await channel
-        await asyncio.sleep(1)
+        frame_buffer.show_only((i,), brightness)
+        await frame_buffer.send()
+        await asyncio.sleep(settle_time)
 
 
 async def blink_one_led_continuously(
-    channel: Channel, num_leds: int, i: int, brightness_queue
+    frame_buffer: LedFrameBuffer, i: int, calibration_state
 ):
     while True:
-        current_brightness, _ = brightness_queue.get()
+        seen_version = calibration_state.version
+        current_brightness, _ = calibration_state.get()
+        if current_brightness is None:
+            await calibration_state.wait_for_change(seen_version)
+            continue
         print("Blinking LED" + str(i) + " at brightness " + str(current_brightness))
-        await channel.set_values(
-            create_single_pixel_channel(num_leds, i, current_brightness)
-        )
-        await asyncio.sleep(1)
-        all_off_array = [0] * get_channel_width(
-            num_leds
-        )  # Brightness is 0 and all LEDs are black
-        await channel.set_values(all_off_array)
+        frame_buffer.show_only((i,), current_brightness)
+        await frame_buffer.send()
+        # Show a new brightness straight away instead of after the blink
+        if await calibration_state.wait_for_change(seen_version, timeout=1):
+            continue
+        # Brightness is 0 and all LEDs are black
+        frame_buffer.clear()
+        frame_buffer.set_brightness(0)
+        await frame_buffer.send()
         await asyncio.sleep(1)
 
 
 async def calibration_blink(
-    ip_address: str, num_leds: int, brightness_queue
+    ip_address: str, num_leds: int, calibration_state, transport: str = "artnet"
 ) -> asyncio.Task[NoReturn]:
     print("Setting up LEDs")
-    channel = await setup_artnet_leds(ip_address, num_leds)
+    frame_buffer = await setup_leds(ip_address, num_leds, transport)
     print("LEDs are ready")
     return asyncio.ensure_future(
-        blink_one_led_continuously(channel, num_leds, 1, brightness_queue)
+        blink_one_led_continuously(frame_buffer, 1, calibration_state)
     )
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+import socket
+import time
+
+from led_camera_map import timing
+from led_camera_map.led_frame_buffer import CHANNELS_PER_LED, WHITE, LedFrameBuffer
+
+DDP_PORT = 4048
+DDP_FLAGS_VERSION_1 = 0x40
+DDP_FLAGS_PUSH = 0x01  # Show the frame once this packet arrives
+DDP_TYPE_RGB24 = 0x0B
+DDP_ID_DISPLAY = 1
+DDP_CHANNELS_PER_PACKET = 1440  # 480 RGB LEDs, what WLED sends and expects at most
+# WLED drops out of realtime mode after 2.5 s without packets, like pyartnet's
+# refresh this resends the first LED when nothing else was sent for a while
+KEEP_ALIVE_INTERVAL = 1.0
+
+
+def make_ddp_header(sequence, offset, length, push):
+    flags = DDP_FLAGS_VERSION_1 | (DDP_FLAGS_PUSH if push else 0)
+    return (
+        bytes((flags, sequence, DDP_TYPE_RGB24, DDP_ID_DISPLAY))
+        + offset.to_bytes(4, "big")
+        + length.to_bytes(2, "big")
+    )
+
+
+class DdpFrameBuffer(LedFrameBuffer):
+    # Drives WLED over DDP: every packet holds a run of up to 480 RGB LEDs at any
+    # offset, so only the range of LEDs that changed since the last send goes out.
+    # DDP has no dimmer channel, so colours are scaled by the brightness here.
+    def __init__(self, ip_address: str, num_leds: int, port: int = DDP_PORT):
+        super().__init__(num_leds)
+        # Resolved once, not for every packet
+        self._address = (socket.gethostbyname(ip_address), port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._buffer = bytearray(num_leds * CHANNELS_PER_LED)
+        self._view = memoryview(self._buffer)
+        self._brightness = 255
+        self._sequence = 0
+        # The first send blanks the whole strip, whatever it showed before
+        self._dirty_start = 0
+        self._dirty_end = len(self._buffer)
+        self.keep_alive_task: asyncio.Future | None = None
+
+    def _write(self, position: int, color: tuple[int, int, int]):
+        offset = position * CHANNELS_PER_LED
+        self._buffer[offset : offset + CHANNELS_PER_LED] = bytes(
+            value * self._brightness // 255 for value in color
+        )
+        self._dirty_start = min(self._dirty_start, offset)
+        self._dirty_end = max(self._dirty_end, offset + CHANNELS_PER_LED)
+
+    def set_brightness(self, brightness: int):
+        if brightness != self._brightness:
+            self._brightness = brightness
+            for position, color in self._colors.items():
+                self._write(position, color)
+
+    def set_led(self, position: int, color: tuple[int, int, int] = WHITE):
+        super().set_led(position, color)
+        self._write(position, color)
+
+    async def keep_alive(self):
+        while True:
+            await asyncio.sleep(KEEP_ALIVE_INTERVAL)
+            if time.monotonic() - self.sent_at >= KEEP_ALIVE_INTERVAL:
+                self._dirty_start = min(self._dirty_start, 0)
+                self._dirty_end = max(self._dirty_end, CHANNELS_PER_LED)
+                await self.send()
+
+    async def send(self):
+        start, end = self._dirty_start, self._dirty_end
+        if start >= end:
+            return
+        with timing.span("ddp.send", channels=end - start):
+            for offset in range(start, end, DDP_CHANNELS_PER_PACKET):
+                length = min(DDP_CHANNELS_PER_PACKET, end - offset)
+                # Sequence numbers run from 1 to 15, 0 means "not used"
+                self._sequence = self._sequence % 15 + 1
+                header = make_ddp_header(
+                    self._sequence, offset, length, offset + length >= end
+                )
+                self._socket.sendto(
+                    header + self._view[offset : offset + length], self._address
+                )
+        self._dirty_start = len(self._buffer)
+        self._dirty_end = 0
+        self.sent_at = time.monotonic()
+
+    def close(self):
+        if self.keep_alive_task is not None:
+            self.keep_alive_task.cancel()
+            self.keep_alive_task = None
+        self._socket.close()
+
+
+async def setup_ddp_leds(ip_address: str, num_leds: int) -> DdpFrameBuffer:
+    frame_buffer = DdpFrameBuffer(ip_address, num_leds)
+    # Runs until close(), like pyartnet's refresh task
+    frame_buffer.keep_alive_task = asyncio.ensure_future(frame_buffer.keep_alive())
+    return frame_buffer
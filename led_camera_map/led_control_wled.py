@@ -1,15 +1,37 @@
+import hashlib
 import json
+import threading
 import time
 import requests
 
+from led_camera_map import timing
+
+# One pooled HTTP session per controller, so repeated calls reuse the connection
+SESSIONS: dict[str, requests.Session] = {}
+SESSIONS_LOCK = threading.Lock()
+
+
+def get_session(wled_ip) -> requests.Session:
+    with SESSIONS_LOCK:
+        session = SESSIONS.get(wled_ip)
+        if session is None:
+            session = requests.Session()
+            session.hooks["response"].append(timing.record_http_response)
+            SESSIONS[wled_ip] = session
+        return session
+
 
 def get_full_info(wled_ip):
-    info_response = requests.get(f"http://{wled_ip}/json/info", timeout=5)
+    info_response = get_session(wled_ip).get(
+        f"http://{wled_ip}/json/info", timeout=5
+    )
     return json.loads(info_response.text)
 
 
 def get_full_state(wled_ip):
-    state_response = requests.get(f"http://{wled_ip}/json/state", timeout=5)
+    state_response = get_session(wled_ip).get(
+        f"http://{wled_ip}/json/state", timeout=5
+    )
     return json.loads(state_response.text)
 
 
@@ -20,13 +42,24 @@ def get_led_count(wled_ip):
     return num_leds
 
 
+def find_ledmap_id(info, ledmap_name):
+    # Returns None when WLED doesn't list the ledmap (yet)
+    for ledmap in info.get("maps", []):
+        if "n" in ledmap and ledmap["n"] in (ledmap_name, ledmap_name + ".json"):
+            return ledmap["id"]
+    # Some builds only list ids, which are the number in the file name
+    listed_ids = [
+        ledmap["id"] for ledmap in info.get("maps", []) if "n" not in ledmap
+    ]
+    map_number = ledmap_name.removeprefix("ledmap")
+    if map_number.isdigit() and int(map_number) in listed_ids:
+        return int(map_number)
+    return None
+
+
 def set_current_ledmap_to_name(wled_ip, ledmap_name):
     info = get_full_info(wled_ip)
-    ledmap_id = 0
-
-    for ledmap in info["maps"]:
-        if "n" in ledmap and ledmap["n"] in (ledmap_name, ledmap_name + ".json"):
-            ledmap_id = ledmap["id"]
+    ledmap_id = find_ledmap_id(info, ledmap_name) or 0
 
     set_current_ledmap_to_id(wled_ip, ledmap_id)
 
@@ -36,18 +69,19 @@ def set_current_ledmap_to_id(wled_ip, ledmap_id):
     print("Setting LEDMap to id", str(ledmap_id))
     state = {}
     state["ledmap"] = ledmap_id
-    response = requests.post(
+    response = get_session(wled_ip).post(
         f"http://{wled_ip}/json/state", data=json.dumps(state), timeout=5
     )
     print("Set LEDmap response ", response.text)
 
-def upload_ledmap(wled_ip, ledmap_name):
+def upload_ledmap(wled_ip, ledmap_name, output_dir="out"):
     print("Uploading ledmap to " + wled_ip)
 
     files = {
         "data": (
             "/" + ledmap_name + ".json",  # WLED requires filename to start with /
-            open("out/" + ledmap_name + ".json", "rb"),  # Json was written to a file
+            # Json was written to a file
+            open(output_dir + "/" + ledmap_name + ".json", "rb"),
             "text/json",
             {
                 "Content-Type": "text/json",
@@ -58,22 +92,58 @@ def upload_ledmap(wled_ip, ledmap_name):
         )
     }
 
-    response = requests.post(f"http://{wled_ip}/edit", files=files, timeout=5)
+    response = get_session(wled_ip).post(
+        f"http://{wled_ip}/edit", files=files, timeout=5
+    )
 
     print("Upload response ", response.text)
     assert response.status_code == 200
     return response
 
 
+def get_file_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def get_device_file_hash(wled_ip, ledmap_name):
+    # WLED serves the files on its filesystem from the root
+    response = get_session(wled_ip).get(
+        f"http://{wled_ip}/{ledmap_name}.json", timeout=5
+    )
+    if response.status_code != 200:
+        return None
+    return get_file_hash(response.content)
+
+
+def wait_for_wled(wled_ip, previous_uptime=None, timeout=30):
+    # Poll with a growing delay until the JSON API answers, and if we rebooted, until
+    # WLED was seen going down or its uptime shows it's the rebooted instance answering
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    went_down = False
+    while time.monotonic() < deadline:
+        try:
+            info = get_full_info(wled_ip)
+            if (
+                previous_uptime is None
+                or went_down
+                or info.get("uptime", 0) < previous_uptime
+            ):
+                return info
+        except (requests.exceptions.RequestException, ValueError):
+            went_down = True
+        time.sleep(delay)
+        delay = min(delay * 2, 2)
+    print("WLED didn't respond within", timeout, "seconds")
+    return None
+
+
 def reboot_wled(wled_ip):
     print("Wait up to 30 seconds for WLED to reboot...")
-    requests.get(f"http://{wled_ip}/reset", timeout=5)  # Perform the reboot
-    for _ in range(20):
-        try:
-            return requests.head(f"http://{wled_ip}/json/", timeout=1)
-        except requests.exceptions.ConnectionError:
-            time.sleep(1)
-    time.sleep(5)  # Once it's booted, give it more time to get the json api responding
+    previous_uptime = get_full_info(wled_ip).get("uptime")
+    # Perform the reboot
+    get_session(wled_ip).get(f"http://{wled_ip}/reset", timeout=5)
+    return wait_for_wled(wled_ip, previous_uptime)
 
 def set_linear_segment(wled_ip, num_leds):
 
@@ -96,7 +166,7 @@ def set_linear_segment(wled_ip, num_leds):
     state["seg"] = [segment]
     state["ledmap"] = 0
 
-    response = requests.post(
+    response = get_session(wled_ip).post(
         f"http://{wled_ip}/json/state", data=json.dumps(state), timeout=5
     )
     print("Setting segment response ", response.text)
@@ -120,18 +190,75 @@ def set_2d_segment(wled_ip, width, height, ledmap_id):
     state["ledmap"] = ledmap_id
 
 
-    response = requests.post(
+    response = get_session(wled_ip).post(
         f"http://{wled_ip}/json/state", data=json.dumps(state), timeout=5
     )
     print("Setting segment response ", response.text)
     return response
 
-def apply_ledmap(wled_ip, ledmap_name):
-    response = upload_ledmap(wled_ip, ledmap_name)
-    if response.status_code != 200:
-        return
-    reboot_wled(wled_ip)
-    ledmap_id = set_current_ledmap_to_name(wled_ip, ledmap_name)
+def light_2d_area(wled_ip, start, stop, start_y, stop_y, brightness):
+    # Lights columns start to stop and rows start_y to stop_y of the 2D layout white,
+    # through the ledmap. Live override keeps ArtNet or DDP data from covering it.
+    segment = {}
+    segment["id"] = 0
+    segment["start"] = start
+    segment["stop"] = stop
+    segment["startY"] = start_y
+    segment["stopY"] = stop_y
+    segment["col"] = [[255, 255, 255], [0, 0, 0], [0, 0, 0]]
+    segment["fx"] = 0
+    segment["sel"] = True
+    segment["on"] = True
+
+    state = {}
+    state["on"] = True
+    state["bri"] = brightness
+    state["lor"] = 1
+    state["seg"] = [segment]
+
+    return get_session(wled_ip).post(
+        f"http://{wled_ip}/json/state", data=json.dumps(state), timeout=5
+    )
+
+
+def set_power(wled_ip, on: bool):
+    return get_session(wled_ip).post(
+        f"http://{wled_ip}/json/state", data=json.dumps({"on": on}), timeout=5
+    )
+
+
+def end_live_override(wled_ip):
+    return get_session(wled_ip).post(
+        f"http://{wled_ip}/json/state", data=json.dumps({"lor": 0}), timeout=5
+    )
+
+
+def apply_ledmap(wled_ip, ledmap_name, output_dir="out"):
+    with open(output_dir + "/" + ledmap_name + ".json", "rb") as ledmap_file:
+        local_hash = get_file_hash(ledmap_file.read())
+    info = get_full_info(wled_ip)
+    ledmap_id = find_ledmap_id(info, ledmap_name)
+
+    device_hash = None
+    if ledmap_id is not None:
+        device_hash = get_device_file_hash(wled_ip, ledmap_name)
+    if device_hash == local_hash:
+        print(ledmap_name, "on WLED is already up to date, skipping upload")
+    else:
+        response = upload_ledmap(wled_ip, ledmap_name, output_dir)
+        if response.status_code != 200:
+            return
+        if ledmap_id is None:
+            # WLED only lists new ledmap files after a reboot
+            info = reboot_wled(wled_ip) or get_full_info(wled_ip)
+            ledmap_id = find_ledmap_id(info, ledmap_name)
+    if ledmap_id is None:
+        if ledmap_name != "ledmap0":
+            print("WLED doesn't list", ledmap_name, "even after a reboot")
+            return None
+        ledmap_id = 0
+    # Setting the ledmap makes WLED reload the file, so no reboot is needed for changes
+    set_current_ledmap_to_id(wled_ip, ledmap_id)
 
     state = get_full_state(wled_ip)
     if state["ledmap"] != ledmap_id:
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+CHANNELS_PER_LED = 3
+WHITE = (255, 255, 255)
+
+
+class LedFrameBuffer:
+    # What the mapping code needs from a way of driving the LEDs, see
+    # led_control_artnet.setup_leds. Keeps track of which LEDs are lit, every
+    # transport writes the colours into its own buffer and sends them its own way.
+    def __init__(self, num_leds: int):
+        self.num_leds = num_leds
+        self._colors: dict[int, tuple[int, int, int]] = {}  # The lit LEDs
+        self.sent_at = 0.0  # time.monotonic() of the last send
+
+    def set_brightness(self, brightness: int):
+        raise NotImplementedError
+
+    def set_led(self, position: int, color: tuple[int, int, int] = WHITE):
+        # Transports write the colour to their buffer and call this too
+        if any(color):
+            self._colors[position] = color
+        else:
+            self._colors.pop(position, None)
+
+    def clear_led(self, position: int):
+        self.set_led(position, (0, 0, 0))
+
+    def clear(self):
+        for position in list(self._colors):
+            self.clear_led(position)
+
+    def show_only(self, positions, brightness: int, color=WHITE):
+        self.show_colors({position: color for position in positions}, brightness)
+
+    def show_colors(self, colors: dict[int, tuple[int, int, int]], brightness: int):
+        # Only the LEDs that were lit before and the new ones are touched
+        for position in self._colors.keys() - colors.keys():
+            self.clear_led(position)
+        self.set_brightness(brightness)
+        for position, color in colors.items():
+            self.set_led(position, color)
+
+    async def send(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
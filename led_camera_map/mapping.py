@@ -3,12 +3,111 @@ from __future__ import annotations
 
 import asyncio
 import concurrent.futures
+import json
+import os
+import threading
+import time
 from contextlib import suppress
-from led_camera_map import camera, format_map, led_control_artnet, led_control_wled
+
+import numpy as np
+
+from led_camera_map import (
+    camera,
+    checkpoint,
+    debug_archive,
+    format_map,
+    led_control_artnet,
+    led_control_wled,
+    recording,
+    spatial_index,
+    timing,
+    triangulation,
+    verification,
+)
 
 WLED_IP = "wled.local"
+# To map several controllers that share one camera view, list them all here instead
+WLED_IPS: list[str] = []
 LED_MAP_OUTPUT_NAME = "ledmap2"
 CAMERA_ID = 0
+# "artnet" drives the LEDs through WLED's ArtNet "Dimmer + Multi RGB" mode. "ddp"
+# needs no WLED setup and only sends the LEDs that changed, for large installs.
+LED_TRANSPORT = "artnet"
+# To map in 3D, list two or more cameras here and describe where each one is in
+# CAMERA_POSES_FILE. Calibration still uses CAMERA_ID.
+CAMERA_IDS: list[int] = []
+CAMERA_POSES_FILE = "cameras.json"
+# How 3D positions become a WLED map: "project" drops the axis not in LEDMAP_3D_AXES,
+# with LEDMAP_3D_SCALE grid cells per unit of the camera poses, then goes through the
+# same 2D steps as a camera map. "voxelize" snaps the LEDs into LEDMAP_WIDTH x
+# LEDMAP_HEIGHT x LEDMAP_DEPTH voxels and stacks the depth layers below each other.
+# With several cameras every LED is flashed on its own, MAPPING_MODE and
+# CHECKPOINT_MODE only apply to one camera.
+LEDMAP_3D_MODE = "project"
+LEDMAP_3D_AXES = "xy"
+LEDMAP_3D_SCALE = 1.0
+LEDMAP_DEPTH = 4
+# "single" flashes one LED per frame, "gray_code" maps N LEDs in 2*ceil(log2(N)) frames
+# and "rgb" flashes three LEDs per frame in red, green and blue
+MAPPING_MODE = "single"
+# A gray code run can't decode anything without all of its frames
+GRAY_CODE_CAPTURE_ATTEMPTS = 3
+# In "rgb" mode the threshold applies to how much brighter an LED's colour is than
+# the other two colours, instead of the calibrated threshold
+RGB_THRESHOLD = 60
+# Subtract a frame captured with all LEDs off before thresholding, to map in lit rooms.
+# The threshold then applies to the brightness difference, not the absolute brightness.
+USE_DARK_FRAME = False
+DARK_FRAME_THRESHOLD = 60
+# Watch the camera and capture as soon as the LED change has settled, not after a sleep.
+# LEDs that don't settle within SETTLE_TIMEOUT seconds are captured anyway and reported.
+USE_SETTLE_DETECTION = True
+SETTLE_TIMEOUT = 0.5
+# How many captured frames may wait for detection while the next LEDs are captured
+PIPELINE_DEPTH = 8
+DETECTION_WORKERS = 4
+# Search for each LED near the previous LEDs before searching the whole frame
+USE_ROI_DETECTION = True
+ROI_MARGIN = 40
+# Snap LED positions onto a grid of this size instead of one row/column per pixel.
+# Leave all three as None to keep every distinct pixel row and column.
+LEDMAP_WIDTH = None
+LEDMAP_HEIGHT = None
+LEDMAP_MAX_CELLS = None
+# Save every captured frame to out/recording, to rerun detection later with other
+# settings: python -m led_camera_map.recording out/recording --threshold 120
+RECORD_SESSION = False
+# Every detection is appended to out/checkpoint.bin. None starts a fresh run,
+# "resume" continues after the last LED in the checkpoint, and "remap" only flashes
+# the LEDs that weren't found or were flagged as outliers.
+CHECKPOINT_MODE = None
+# Flag LEDs found in the same spot as another LED (closer than DUPLICATE_DISTANCE
+# pixels), and LEDs far from both their strip neighbours (more than OUTLIER_FACTOR
+# times the usual distance between neighbours), which are usually reflections.
+# Flagged LEDs are marked in the checkpoint, so "remap" flashes them again. With
+# EXCLUDE_FLAGGED_LEDS they are also left out of this run's ledmap.
+CHECK_LOCATIONS = True
+DUPLICATE_DISTANCE = 3
+OUTLIER_FACTOR = 4
+EXCLUDE_FLAGGED_LEDS = False
+# Pick the brightness and threshold without the calibration window, by flashing a
+# few LEDs at each of these brightnesses and comparing what the camera sees
+AUTO_CALIBRATION = False
+AUTO_CALIBRATION_BRIGHTNESSES = (16, 48, 96, 160, 255)
+AUTO_CALIBRATION_SAMPLES = 6
+# Turn off auto exposure, gain and white balance once calibrated, so the camera
+# doesn't brighten or darken the frames as LEDs turn on and off
+LOCK_EXPOSURE = True
+# After uploading, light bands of rows and columns of the new ledmap through WLED
+# and check every LED lights up where the map puts it. At most VERIFY_MAX_PATTERNS
+# bands are used. LEDs that don't are saved to out/verification.json, and with
+# REMAP_MISMAPPED_LEDS they are flashed again and the ledmap is uploaded once more.
+VERIFY_LEDMAP = True
+VERIFY_MAX_PATTERNS = 64
+REMAP_MISMAPPED_LEDS = True
+# Time every stage of the run, print a summary at the end and save a Chrome trace
+# (open it in chrome://tracing or https://ui.perfetto.dev) to out/timing_trace.json
+ENABLE_TIMING = False
 
 
 def cancel_all_tasks():
@@ -19,17 +118,6 @@ def cancel_all_tasks():
             task.cancel()
 
 
-def location_already_found(locations, this_location, distance):
-    # Check the last location first, since it's most likely to be what's nearby
-    for location in reversed(locations):
-        if (
-            abs(this_location[0] - location[0]) < distance
-            and abs(this_location[1] - location[1]) < distance
-        ):
-            # print ("Found existing location ", location, thisLocation)
-            return True
-    return False
-
 def get_user_confirmation(message:str):
     print(message)
     key_pressed = input(str("Type y and press Enter to confirm, any other input will exit: "))
@@ -37,11 +125,127 @@ def get_user_confirmation(message:str):
         print("Exiting")
         quit() 
 
-async def run_mapping_task(brightness, threshold, num_leds):
-    locations = []
-    channel = await led_control_artnet.setup_artnet_leds(WLED_IP, num_leds)
+async def capture_frame(vc, reference_frame):
+    # Returns the frame to analyse and whether the settle timeout was hit
+    if not USE_SETTLE_DETECTION or reference_frame is None:
+        return camera.get_frame(vc), False
+    # Run in a thread so the event loop can keep sending ArtNet packets meanwhile
+    with timing.span("camera.settle"):
+        return await asyncio.to_thread(
+            camera.wait_for_led_change, vc, reference_frame, SETTLE_TIMEOUT
+        )
+
+
+def report_settle_timeouts(timed_out):
+    if timed_out:
+        print(
+            "Camera didn't see", len(timed_out), "changes settle in time:", timed_out
+        )
+
+
+def detect_led(
+    i,
+    frame,
+    threshold,
+    dark_frame,
+    search_window,
+    crop_writer,
+    channel=None,
+):
+    with timing.span("detect", led=i, roi=search_window is not None):
+        location, _, _ = camera.get_led_position(
+            frame,
+            threshold,
+            minimum_dimension=0,
+            dark_frame=dark_frame,
+            search_window=search_window,
+            channel=channel,
+            debug_images=False,
+        )
+    crop_writer.save(i, frame, location)
+    return location
+
+
+def record_location(checkpoint_file, checker, locations, i, location):
+    locations[i] = location
+    checkpoint.append_checkpoint(checkpoint_file, i, location)
+    if checker is None:
+        return
+    # Flagged LEDs get a second record, so CHECKPOINT_MODE "remap" flashes them again
+    for j, reason in checker.add(i, location):
+        print("LED", j, "at", locations[j], "looks like a", reason)
+        checkpoint.append_checkpoint(
+            checkpoint_file, j, locations[j], checkpoint.FLAG_OUTLIER
+        )
+
+
+def create_location_checker(num_leds, known_locations=None):
+    if not CHECK_LOCATIONS:
+        return None
+    return spatial_index.LocationChecker(
+        num_leds, known_locations, DUPLICATE_DISTANCE, OUTLIER_FACTOR
+    )
+
+
+def drop_flagged_locations(locations, checker):
+    if checker is None or not checker.flagged:
+        return locations
+    print(len(checker.flagged), "LEDs were flagged:", sorted(checker.flagged))
+    if not EXCLUDE_FLAGGED_LEDS:
+        print('Set CHECKPOINT_MODE = "remap" to flash them again')
+        return locations
+    return [
+        (-1, -1) if i in checker.flagged else location
+        for i, location in enumerate(locations)
+    ]
+
 
-    vc = camera.open_camera(CAMERA_ID)
+async def collect_locations(pending, locations, checkpoint_file, checker):
+    # Futures are queued in LED order, so locations come back in LED order too.
+    # An LED whose detection fails counts as not found and the queue keeps draining,
+    # a collector that stopped would leave the capture waiting on a full queue. The
+    # first error is raised once the capture is done.
+    error = None
+    while True:
+        item = await pending.get()
+        if item is None:
+            break
+        i, future = item
+        try:
+            location = await future
+            print("Found LED ", i, " at ", location)
+            record_location(checkpoint_file, checker, locations, i, location)
+        except Exception as exception:
+            print("Detecting LED", i, "failed:", repr(exception))
+            locations[i] = (-1, -1)
+            error = error or exception
+    if error is not None:
+        raise error
+
+
+async def run_mapping_task(
+    brightness,
+    threshold,
+    num_leds,
+    wled_ip=None,
+    output_dir="out",
+    led_indexes=None,
+    known_locations=None,
+    checkpoint_file=None,
+):
+    # Only the LEDs in led_indexes are flashed, the others keep their known location
+    if led_indexes is None:
+        led_indexes = range(num_leds)
+    locations = list(known_locations or [None] * num_leds)
+    if checkpoint_file is None:
+        checkpoint_file = checkpoint.open_checkpoint(
+            checkpoint.get_checkpoint_path(output_dir)
+        )
+    frame_buffer = await led_control_artnet.setup_leds(
+        wled_ip or WLED_IP, num_leds, LED_TRANSPORT
+    )
+
+    vc = camera.get_camera_session(CAMERA_ID)
 
     print(
         "Starting LED location capture with LED brightness "
@@ -49,44 +253,411 @@ async def run_mapping_task(brightness, threshold, num_leds):
         + " and threshold "
         + str(threshold)
     )
-    for i in range(num_leds):
-        await led_control_artnet.light_one_led(channel, num_leds, i, brightness)
-        await asyncio.sleep(0)
+    dark_frame = None
+    if MAPPING_MODE == "rgb":
+        # Colour channels are compared against each other, not against the grey
+        # brightness the threshold was calibrated for
+        threshold = RGB_THRESHOLD
+    elif USE_DARK_FRAME:
+        print("Capturing dark frame with all LEDs off")
+        frame_buffer.clear()
+        await frame_buffer.send()
+        await asyncio.sleep(0.2)
+        dark_frame = camera.capture_dark_frame(vc)
+        threshold = DARK_FRAME_THRESHOLD
 
-        frame = camera.get_frame(vc)
-        location, _, _ = camera.get_led_position(
-            frame, threshold, save_image=True, minimum_dimension=0
+    # LED i+1 is lit and captured while LED i is detected in the pool and its debug
+    # crop is stored in the background.
+    loop = asyncio.get_running_loop()
+    pending = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+    checker = create_location_checker(num_leds, known_locations)
+    collector = asyncio.create_task(
+        collect_locations(pending, locations, checkpoint_file, checker)
+    )
+    crop_writer = debug_archive.CropArchiveWriter(
+        debug_archive.get_debug_archive_dir(output_dir),
+        num_leds,
+        resume=known_locations is not None,
+    )
+    crop_writer.start()
+
+    settle_time = 0 if USE_SETTLE_DETECTION else led_control_artnet.SETTLE_TIME
+    reference_frame = camera.get_frame(vc)
+    timed_out = []
+    # In "rgb" mode three LEDs share each frame, one per colour channel
+    leds_per_frame = len(camera.RGB_CHANNELS) if MAPPING_MODE == "rgb" else 1
+    channels = camera.RGB_CHANNELS if MAPPING_MODE == "rgb" else (None,)
+    led_indexes = list(led_indexes)
+    recorder = None
+    if RECORD_SESSION and reference_frame is not None:
+        recorder = recording.SessionRecorder(
+            recording.get_recording_dir(output_dir, known_locations is not None),
+            -(-len(led_indexes) // leds_per_frame),
+            reference_frame.shape,
+            MAPPING_MODE,
+            num_leds,
+            threshold,
         )
+        if dark_frame is not None:
+            recorder.save_dark_frame(dark_frame)
+    with concurrent.futures.ThreadPoolExecutor(DETECTION_WORKERS) as pool:
+        for start in range(0, len(led_indexes), leds_per_frame):
+            group = led_indexes[start : start + leds_per_frame]
+            with timing.span("led.capture", led=group[0]):
+                if MAPPING_MODE == "rgb":
+                    await led_control_artnet.light_rgb_leds(
+                        frame_buffer, group, brightness, settle_time
+                    )
+                else:
+                    await led_control_artnet.light_one_led(
+                        frame_buffer, group[0], brightness, settle_time
+                    )
+                await asyncio.sleep(0)
 
-        # if not location == (-1, -1):
-        # if not location_already_found(locations, location, 3):
-        print("Found LED at ", location)
-        locations.append(location)
+                frame, hit_timeout = await capture_frame(vc, reference_frame)
+            if hit_timeout:
+                timed_out.extend(group)
+            reference_frame = frame
+            if recorder is not None:
+                recorder.add(
+                    frame,
+                    group,
+                    channels[: len(group)],
+                    frame_buffer.sent_at,
+                    vc.last_timestamp,
+                )
+            for i, channel in zip(group, channels):
+                if frame is None:
+                    print("Couldn't get a frame for LED", i)
+                    future = loop.create_future()
+                    future.set_result((-1, -1))
+                    await pending.put((i, future))
+                    continue
+                search_window = None
+                if USE_ROI_DETECTION:
+                    # Only LEDs that were already detected feed the prediction
+                    search_window = camera.predict_search_window(
+                        locations, i, frame.shape, ROI_MARGIN
+                    )
+                future = loop.run_in_executor(
+                    pool,
+                    detect_led,
+                    i,
+                    frame,
+                    threshold,
+                    dark_frame,
+                    search_window,
+                    crop_writer,
+                    channel,
+                )
+                with timing.span("pipeline.wait", led=i):
+                    await pending.put((i, future))
+
+        print("Finishing LED location capture")
+        frame_buffer.clear()
+        await frame_buffer.send()
+        frame_buffer.close()
+        await pending.put(None)
+        await collector
+
+    crop_writer.close()
+    checkpoint_file.close()
+    if recorder is not None:
+        recorder.close()
+    report_settle_timeouts(timed_out)
+
+    locations = [(-1, -1) if location is None else location for location in locations]
+    return drop_flagged_locations(locations, checker)
+
+
+async def run_gray_code_mapping_task(
+    brightness, threshold, num_leds, wled_ip=None, output_dir="out"
+):
+    frame_buffer = await led_control_artnet.setup_leds(
+        wled_ip or WLED_IP, num_leds, LED_TRANSPORT
+    )
+
+    vc = camera.get_camera_session(CAMERA_ID)
+
+    num_bits = led_control_artnet.get_gray_code_bit_count(num_leds)
+    print(
+        "Starting gray code LED location capture of "
+        + str(num_bits * 2)
+        + " frames with LED brightness "
+        + str(brightness)
+        + " and threshold "
+        + str(threshold)
+    )
+    settle_time = 0 if USE_SETTLE_DETECTION else led_control_artnet.SETTLE_TIME
+    reference_frame = camera.get_frame(vc)
+    recorder = None
+    if RECORD_SESSION and reference_frame is not None:
+        recorder = recording.SessionRecorder(
+            recording.get_recording_dir(output_dir),
+            num_bits * 2,
+            reference_frame.shape,
+            "gray_code",
+            num_leds,
+            threshold,
+        )
+    timed_out = []
+    frame_pairs = []
+    for bit in range(num_bits):
+        frames = []
+        for complement in (False, True):
+            await led_control_artnet.light_gray_code_pattern(
+                frame_buffer, bit, complement, brightness, settle_time
+            )
+            await asyncio.sleep(0)
+            # Every LED needs every frame, so a dropped one is captured again
+            for _ in range(GRAY_CODE_CAPTURE_ATTEMPTS):
+                frame, hit_timeout = await capture_frame(vc, reference_frame)
+                if frame is not None:
+                    break
+                print("Couldn't get a frame for gray code bit", bit)
+            if hit_timeout:
+                timed_out.append((bit, complement))
+            if frame is not None:
+                reference_frame = frame
+            frames.append(frame)
+            if recorder is not None:
+                recorder.add(
+                    frame,
+                    [],
+                    [],
+                    frame_buffer.sent_at,
+                    vc.last_timestamp,
+                    (bit, complement),
+                )
+        frame_pairs.append(tuple(frames))
 
     print("Finishing LED location capture")
-    vc.release()
+    if recorder is not None:
+        recorder.close()
+    report_settle_timeouts(timed_out)
+    frame_buffer.clear()
+    await frame_buffer.send()
+    frame_buffer.close()
 
+    locations = camera.decode_gray_code_frames(frame_pairs, threshold, num_leds)
+    for i, location in enumerate(locations):
+        print("Found LED ", i, " at ", location)
     return locations
 
 
-async def main():
-    print("Getting number of LEDs from WLED")
-    print("If this is a different number than you expected, go to 2D configuration")
-    print("and make sure your width is the number of LEDs and the height is 2.")
-    num_leds = led_control_wled.get_led_count(WLED_IP)
-    print("WLED reports", num_leds, "LEDs")  # ArtNet requires 512 or less per universe
-    get_user_confirmation("Is that the number of LEDs you expected?")
+async def run_multi_camera_mapping_task(
+    brightness, threshold, num_leds, wled_ip=None, output_dir="out"
+):
+    camera_poses = triangulation.load_camera_poses(CAMERA_POSES_FILE)
+    frame_buffer = await led_control_artnet.setup_leds(
+        wled_ip or WLED_IP, num_leds, LED_TRANSPORT
+    )
+    camera_sessions = [camera.get_camera_session(camera_id) for camera_id in CAMERA_IDS]
+    crop_writers = []
+    for camera_session in camera_sessions:
+        crop_writer = debug_archive.CropArchiveWriter(
+            debug_archive.get_debug_archive_dir(
+                output_dir + "/camera" + str(camera_session.camera_id)
+            ),
+            num_leds,
+        )
+        crop_writer.start()
+        crop_writers.append(crop_writer)
 
-    print("Setting WLED's /ledmap0.json to a basic linear map")
-    format_map.generate_basic_ledmap(num_leds) # creates out/ledmap0.json
-    led_control_wled.apply_ledmap(WLED_IP, "ledmap0")
+    print(
+        "Starting LED location capture with",
+        len(camera_sessions),
+        "cameras, LED brightness",
+        brightness,
+        "and threshold",
+        threshold,
+    )
+    locations_by_camera = {camera_id: [] for camera_id in CAMERA_IDS}
+    loop = asyncio.get_running_loop()
+    settle_time = 0 if USE_SETTLE_DETECTION else led_control_artnet.SETTLE_TIME
+    reference_frames = [camera.get_frame(session) for session in camera_sessions]
+    timed_out = []
+    with concurrent.futures.ThreadPoolExecutor(DETECTION_WORKERS) as pool:
+        for i in range(num_leds):
+            await led_control_artnet.light_one_led(
+                frame_buffer, i, brightness, settle_time
+            )
+            if USE_SETTLE_DETECTION:
+                # Every camera waits for the LED change to settle in its own view
+                captures = await asyncio.gather(
+                    *map(capture_frame, camera_sessions, reference_frames)
+                )
+                frames = [frame for frame, _ in captures]
+                if any(hit_timeout for _, hit_timeout in captures):
+                    timed_out.append(i)
+                reference_frames = [
+                    reference if frame is None else frame
+                    for frame, reference in zip(frames, reference_frames)
+                ]
+            else:
+                # Every camera uses its first frame that arrived after the LED settled
+                lit_at = time.monotonic()
+                frames = await asyncio.gather(
+                    *(
+                        asyncio.to_thread(camera_session.get_frame_after, lit_at)
+                        for camera_session in camera_sessions
+                    )
+                )
+            detections = []
+            for frame, crop_writer in zip(frames, crop_writers):
+                if frame is None:
+                    future = loop.create_future()
+                    future.set_result((-1, -1))
+                    detections.append(future)
+                    continue
+                detections.append(
+                    loop.run_in_executor(
+                        pool,
+                        detect_led,
+                        i,
+                        frame,
+                        threshold,
+                        None,
+                        None,
+                        crop_writer,
+                    )
+                )
+            locations = await asyncio.gather(*detections)
+            for camera_id, location in zip(CAMERA_IDS, locations):
+                locations_by_camera[camera_id].append(location)
+            print("Found LED ", i, " at ", tuple(locations_by_camera.values()))
+
+    print("Finishing LED location capture")
+    for crop_writer in crop_writers:
+        crop_writer.close()
+    report_settle_timeouts(timed_out)
+    frame_buffer.clear()
+    await frame_buffer.send()
+    frame_buffer.close()
+
+    positions_3d = triangulation.triangulate_locations(
+        locations_by_camera, camera_poses
+    )
+    triangulation.save_3d_positions(positions_3d, output_dir)
+    return positions_3d
+
+
+def check_ledmap_settings():
+    # Fails before any LED is flashed instead of after the whole capture
+    if len(CAMERA_IDS) > 1 and LEDMAP_3D_MODE == "voxelize":
+        if LEDMAP_WIDTH is None or LEDMAP_HEIGHT is None or LEDMAP_DEPTH is None:
+            raise ValueError(
+                'LEDMAP_3D_MODE "voxelize" needs LEDMAP_WIDTH, LEDMAP_HEIGHT and '
+                "LEDMAP_DEPTH"
+            )
+
+
+async def map_leds(brightness, threshold, num_leds, wled_ip=None, output_dir="out"):
+    checkpoint_path = checkpoint.get_checkpoint_path(output_dir)
+    if len(CAMERA_IDS) > 1:
+        if CHECKPOINT_MODE is not None:
+            print("Checkpoints are only kept with one camera, mapping all LEDs")
+        # Returns 3D positions, which create_ledmap turns into a WLED map
+        return await run_multi_camera_mapping_task(
+            brightness, threshold, num_leds, wled_ip, output_dir
+        )
+    if CHECKPOINT_MODE in ("resume", "remap"):
+        records = checkpoint.load_checkpoint(checkpoint_path)
+        known_locations = [
+            records[i][0] if i in records else None for i in range(num_leds)
+        ]
+        if CHECKPOINT_MODE == "resume":
+            led_indexes = range(checkpoint.get_resume_index(records), num_leds)
+        else:
+            led_indexes = checkpoint.get_leds_to_remap(records, num_leds)
+        print("Flashing", len(led_indexes), "LEDs missing from the checkpoint")
+        locations = await run_mapping_task(
+            brightness,
+            threshold,
+            num_leds,
+            wled_ip,
+            output_dir,
+            led_indexes,
+            known_locations,
+            checkpoint.open_checkpoint(checkpoint_path, resume=True),
+        )
+    elif MAPPING_MODE == "gray_code":
+        locations = await run_gray_code_mapping_task(
+            brightness, threshold, num_leds, wled_ip, output_dir
+        )
+        # Checkpointed too, so LEDs the decode missed or got wrong can be re-mapped
+        # one at a time
+        checker = create_location_checker(num_leds)
+        with checkpoint.open_checkpoint(checkpoint_path) as checkpoint_file:
+            for i, location in enumerate(list(locations)):
+                record_location(checkpoint_file, checker, locations, i, location)
+        locations = drop_flagged_locations(locations, checker)
+    else:
+        locations = await run_mapping_task(
+            brightness, threshold, num_leds, wled_ip, output_dir
+        )
+    print("Found positions of ", str(len(locations)), " LEDs: ")
+    print(locations)
+    return locations
 
-    print("Creating basic linear segment")
-    led_control_wled.set_linear_segment(WLED_IP, num_leds)
 
-    calibration_proc = camera.LaunchCalibrationWindowProc(CAMERA_ID)
+def create_3d_ledmap(positions_3d, output_dir="out"):
+    if LEDMAP_3D_MODE == "voxelize":
+        linear_list, width, height = format_map.voxelize_3d_map(
+            positions_3d, LEDMAP_WIDTH, LEDMAP_HEIGHT, LEDMAP_DEPTH
+        )
+    else:
+        locations = format_map.project_3d_map(
+            positions_3d, LEDMAP_3D_AXES, LEDMAP_3D_SCALE
+        )
+        linear_list, width, height = format_map.build_2d_map(
+            locations, LEDMAP_WIDTH, LEDMAP_HEIGHT, LEDMAP_MAX_CELLS
+        )
+    ledmap_json = format_map.save_wled_json(
+        LED_MAP_OUTPUT_NAME, linear_list, width, height, output_dir
+    )
+    format_map.visualize_ledmap(ledmap_json, output_dir)
+    return width, height
+
+
+def create_ledmap(locations, output_dir="out", frame=None):
+    # The LED positions are drawn onto frame, or onto a new camera frame without one
+    if len(CAMERA_IDS) > 1:
+        return create_3d_ledmap(locations, output_dir)
+    linear_list, width, height = format_map.build_2d_map(
+        locations, LEDMAP_WIDTH, LEDMAP_HEIGHT, LEDMAP_MAX_CELLS
+    )
+    if frame is None:
+        camera.generate_output_image(
+            CAMERA_ID, locations, LED_MAP_OUTPUT_NAME, output_dir
+        )
+    else:
+        camera.save_output_image(frame, locations, LED_MAP_OUTPUT_NAME, output_dir)
+    ledmap_json = format_map.save_wled_json(
+        LED_MAP_OUTPUT_NAME, linear_list, width, height, output_dir
+    )
+    format_map.visualize_ledmap(ledmap_json, output_dir)
+    return width, height
+
+
+async def calibrate(wled_ip, num_leds):
+    # The window process shows the frames of this process's camera session, so the
+    # camera stays open, and keeps its settings, from calibration through mapping
+    camera_session = camera.get_camera_session(CAMERA_ID)
+    _, frame = camera_session.read()
+    if frame is None:
+        print("Couldn't get a frame from the camera session")
+        return None, None
+    shared_frame = camera.SharedFrame(frame.shape)
+    calibration_proc = camera.LaunchCalibrationWindowProc(CAMERA_ID, shared_frame)
     calibration_proc.start()
-    brightness_queue = calibration_proc.output
+    publisher = threading.Thread(
+        target=camera_session.publish,
+        args=(shared_frame, calibration_proc.stop_event),
+        daemon=True,
+    )
+    publisher.start()
+    calibration_state = calibration_proc.output
 
     led_blink_task = None
     loop = asyncio.get_running_loop()
@@ -94,9 +665,10 @@ async def main():
         led_blink_task = await loop.run_in_executor(
             pool,
             led_control_artnet.calibration_blink,
-            WLED_IP,
+            wled_ip,
             num_leds,
-            brightness_queue,
+            calibration_state,
+            LED_TRANSPORT,
         )
     print("==== PRESS ESC TO FINISH CALIBRATION ===")
     await led_blink_task
@@ -104,26 +676,325 @@ async def main():
     assert brightness is not None, "Ensure the proc is done, and you have values."
     assert threshold is not None, "Ensure that the proc is done, and you have values."
     calibration_proc.join()
+    publisher.join()
 
     print("Stopping calibration LED blink")
     cancel_all_tasks()  # Let's cancel all running tasks before continuing
+    return brightness, threshold
 
-    locations = await run_mapping_task(brightness, threshold, num_leds)
-    print("Found positions of ", str(len(locations)), " LEDs: ")
-    print(locations)
 
-    linear_list, width, height = format_map.flatten_2d_map(locations)
-    camera.generate_output_image(CAMERA_ID, locations, LED_MAP_OUTPUT_NAME)
-    ledmap_json = format_map.save_wled_json(
-        LED_MAP_OUTPUT_NAME, linear_list, width, height
+async def auto_calibrate(wled_ip, num_leds):
+    frame_buffer = await led_control_artnet.setup_leds(
+        wled_ip, num_leds, LED_TRANSPORT
+    )
+    vc = camera.get_camera_session(CAMERA_ID)
+    samples = min(num_leds, AUTO_CALIBRATION_SAMPLES)
+    # Spread the samples over the whole strip
+    led_indexes = sorted(
+        {i * (num_leds - 1) // max(1, samples - 1) for i in range(samples)}
+    )
+    settle_time = 0 if USE_SETTLE_DETECTION else led_control_artnet.SETTLE_TIME
+
+    print("Auto calibrating with LEDs", led_indexes)
+    frame_buffer.clear()
+    await frame_buffer.send()
+    await asyncio.sleep(led_control_artnet.SETTLE_TIME)
+    off_gray_image = camera.capture_dark_frame(vc)
+
+    reference_frame = camera.get_frame(vc)
+    on_frames = {}
+    for brightness in AUTO_CALIBRATION_BRIGHTNESSES:
+        frames = []
+        for i in led_indexes:
+            await led_control_artnet.light_one_led(
+                frame_buffer, i, brightness, settle_time
+            )
+            await asyncio.sleep(0)
+            frame, _ = await capture_frame(vc, reference_frame)
+            if frame is None:
+                continue
+            reference_frame = frame
+            frames.append(frame)
+        if frames:
+            on_frames[brightness] = frames
+
+    frame_buffer.clear()
+    await frame_buffer.send()
+    frame_buffer.close()
+    if off_gray_image is None or not on_frames:
+        print("Couldn't get frames from the camera for auto calibration")
+        return None, None
+
+    results = camera.pick_calibration(off_gray_image, on_frames)
+    print("Brightness  Threshold  Single LEDs  Gap")
+    for brightness, threshold, single_blobs, gap in results:
+        print(
+            f"{brightness:>10}{threshold:>11}{single_blobs:>10}/{len(led_indexes)}"
+            f"{gap:>6}"
+        )
+    brightness, threshold, single_blobs, _ = results[0]
+    if not single_blobs:
+        print("No brightness made the LEDs stand out on their own")
+        return None, None
+    print("Auto calibration picked brightness", brightness, "threshold", threshold)
+    return brightness, threshold
+
+
+async def get_calibration(wled_ip, num_leds):
+    brightness = threshold = None
+    if AUTO_CALIBRATION:
+        brightness, threshold = await auto_calibrate(wled_ip, num_leds)
+        if brightness is None:
+            print("Falling back to the calibration window")
+    if brightness is None:
+        brightness, threshold = await calibrate(wled_ip, num_leds)
+    if LOCK_EXPOSURE:
+        # The threshold only holds as long as the camera doesn't re-adjust
+        for camera_id in CAMERA_IDS or [CAMERA_ID]:
+            camera.get_camera_session(camera_id).lock_exposure()
+    return brightness, threshold
+
+
+def get_controller_output_dir(wled_ip):
+    output_dir = "out/" + "".join(c if c.isalnum() else "_" for c in wled_ip)
+    os.makedirs(output_dir, exist_ok=True)
+    return output_dir
+
+
+async def prepare_controller(wled_ip, output_dir):
+    # The HTTP calls block, so each controller gets its own thread
+    num_leds = await asyncio.to_thread(led_control_wled.get_led_count, wled_ip)
+    print(wled_ip, "reports", num_leds, "LEDs")
+    format_map.generate_basic_ledmap(num_leds, output_dir)
+    await asyncio.to_thread(
+        led_control_wled.apply_ledmap, wled_ip, "ledmap0", output_dir
+    )
+    await asyncio.to_thread(led_control_wled.set_linear_segment, wled_ip, num_leds)
+    return num_leds
+
+
+async def upload_controller_ledmap(wled_ip, output_dir, width, height):
+    ledmap_id = await asyncio.to_thread(
+        led_control_wled.apply_ledmap, wled_ip, LED_MAP_OUTPUT_NAME, output_dir
+    )
+    if ledmap_id is None:
+        print("Couldn't set", LED_MAP_OUTPUT_NAME, "on", wled_ip)
+        return None
+    await asyncio.to_thread(
+        led_control_wled.set_2d_segment, wled_ip, width, height, ledmap_id
+    )
+    return ledmap_id
+
+
+async def verify_ledmap(
+    wled_ip, ledmap_id, brightness, threshold, locations, output_dir="out"
+):
+    # Lights bands of rows and columns of the uploaded ledmap through WLED's 2D
+    # segment, and checks that every LED lights up in the band its cell is in
+    ledmap_path = output_dir + "/" + LED_MAP_OUTPUT_NAME + ".json"
+    with open(ledmap_path, encoding="utf-8") as ledmap_file:
+        ledmap_json = json.load(ledmap_file)
+    width, height = ledmap_json["width"], ledmap_json["height"]
+    patterns, column_band, row_band = verification.get_sweep_patterns(
+        width, height, VERIFY_MAX_PATTERNS
+    )
+    print("Verifying", LED_MAP_OUTPUT_NAME, "with", len(patterns), "sweep patterns")
+
+    vc = camera.get_camera_session(CAMERA_ID)
+    settle_time = 0 if USE_SETTLE_DETECTION else led_control_artnet.SETTLE_TIME
+    reference_frame = camera.get_frame(vc)
+    samples = []
+    for axis, band, area in patterns:
+        with timing.span("verify.pattern", axis=axis, band=band):
+            await asyncio.to_thread(
+                led_control_wled.light_2d_area, wled_ip, *area, brightness
+            )
+            await asyncio.sleep(settle_time)
+            frame, _ = await capture_frame(vc, reference_frame)
+        if frame is None:
+            print("Couldn't get a frame for", axis, "band", band)
+            samples.append(np.zeros(len(locations), dtype=np.uint8))
+            continue
+        reference_frame = frame
+        samples.append(verification.sample_brightness(frame, locations))
+    await asyncio.to_thread(led_control_wled.end_live_override, wled_ip)
+    await asyncio.to_thread(
+        led_control_wled.set_2d_segment, wled_ip, width, height, ledmap_id
+    )
+
+    errors = verification.find_mismapped_leds(
+        locations,
+        # Where create_ledmap put every LED
+        format_map.get_2d_map_cells(
+            locations, LEDMAP_WIDTH, LEDMAP_HEIGHT, LEDMAP_MAX_CELLS
+        ),
+        patterns,
+        samples,
+        threshold,
+        column_band,
+        row_band,
+    )
+    for error in errors:
+        print(
+            "LED",
+            error["led"],
+            "should light in column and row band",
+            error["expected"],
+            "but lit in",
+            error["observed"],
+        )
+    print(len(errors), "LEDs didn't light up where the ledmap puts them")
+    verification.save_verification(errors, output_dir)
+    return errors
+
+
+async def verify_and_remap(
+    wled_ip, ledmap_id, brightness, threshold, locations, output_dir="out"
+):
+    # Only the LEDs that failed verification are flashed again, then the ledmap is
+    # rebuilt, uploaded and checked once more. Returns the final locations.
+    if ledmap_id is None:
+        return locations
+    errors = await verify_ledmap(
+        wled_ip, ledmap_id, brightness, threshold, locations, output_dir
+    )
+    if not errors or not REMAP_MISMAPPED_LEDS:
+        return locations
+
+    mismapped = [error["led"] for error in errors]
+    print("Flashing the", len(mismapped), "mis-mapped LEDs again")
+    # The LEDs are flashed through the ledmap too, so switch back to the linear one
+    num_leds = await prepare_controller(wled_ip, output_dir)
+    known_locations = list(locations)
+    for i in mismapped:
+        known_locations[i] = None
+    locations = await run_mapping_task(
+        brightness,
+        threshold,
+        num_leds,
+        wled_ip,
+        output_dir,
+        mismapped,
+        known_locations,
+        checkpoint.open_checkpoint(
+            checkpoint.get_checkpoint_path(output_dir), resume=True
+        ),
     )
-    format_map.visualize_ledmap(ledmap_json)
+    width, height = create_ledmap(locations, output_dir)
+    ledmap_id = await upload_controller_ledmap(wled_ip, output_dir, width, height)
+    if ledmap_id is not None:
+        await verify_ledmap(
+            wled_ip, ledmap_id, brightness, threshold, locations, output_dir
+        )
+    return locations
+
+
+async def set_controllers_power(wled_ips, on):
+    await asyncio.gather(
+        *(
+            asyncio.to_thread(led_control_wled.set_power, wled_ip, on)
+            for wled_ip in wled_ips
+        )
+    )
+
+
+async def run_multi_controller_session(wled_ips):
+    # All controllers are set up and uploaded to at the same time. Only the LED
+    # capture itself runs one controller after the other, since they share a camera.
+    output_dirs = [get_controller_output_dir(wled_ip) for wled_ip in wled_ips]
+    print("Setting up", len(wled_ips), "controllers with a basic linear map")
+    led_counts = await asyncio.gather(
+        *map(prepare_controller, wled_ips, output_dirs)
+    )
+    get_user_confirmation("Are those the numbers of LEDs you expected?")
+    # Only the controller being captured may light up. WLED still shows ArtNet and
+    # DDP frames while it's off, and goes dark again once they stop.
+    await set_controllers_power(wled_ips, False)
+
+    brightness, threshold = await get_calibration(wled_ips[0], led_counts[0])
+
+    map_sizes = []
+    all_locations = []
+    for wled_ip, num_leds, output_dir in zip(wled_ips, led_counts, output_dirs):
+        print("Mapping the LEDs of", wled_ip)
+        locations = await map_leds(
+            brightness, threshold, num_leds, wled_ip, output_dir
+        )
+        all_locations.append(locations)
+        map_sizes.append(create_ledmap(locations, output_dir))
+
+    get_user_confirmation("Upload these ledmaps to WLED?")
+    print("Proceeding to upload ledmaps to WLED")
+    ledmap_ids = await asyncio.gather(
+        *(
+            upload_controller_ledmap(wled_ip, output_dir, width, height)
+            for wled_ip, output_dir, (width, height) in zip(
+                wled_ips, output_dirs, map_sizes
+            )
+        )
+    )
+    if VERIFY_LEDMAP and len(CAMERA_IDS) <= 1:
+        # One controller after the other again, they share the camera
+        for wled_ip, output_dir, ledmap_id, locations in zip(
+            wled_ips, output_dirs, ledmap_ids, all_locations
+        ):
+            await verify_and_remap(
+                wled_ip, ledmap_id, brightness, threshold, locations, output_dir
+            )
+            # The sweeps and a remap turn the controller on
+            await set_controllers_power([wled_ip], False)
+    await set_controllers_power(wled_ips, True)
+    print("All done")
+
+
+async def main():
+    if ENABLE_TIMING:
+        timing.enable()
+    try:
+        await run_session()
+    finally:
+        camera.close_camera_sessions()
+        if ENABLE_TIMING:
+            timing.print_summary()
+            timing.export_chrome_trace("out/timing_trace.json")
+
+
+async def run_session():
+    check_ledmap_settings()
+    if len(WLED_IPS) > 1:
+        await run_multi_controller_session(WLED_IPS)
+        return
+
+    print("Getting number of LEDs from WLED")
+    print("If this is a different number than you expected, go to 2D configuration")
+    print("and make sure your width is the number of LEDs and the height is 2.")
+    num_leds = led_control_wled.get_led_count(WLED_IP)
+    print("WLED reports", num_leds, "LEDs")  # Spread over universes of 170 RGB LEDs
+    get_user_confirmation("Is that the number of LEDs you expected?")
+
+    print("Setting WLED's /ledmap0.json to a basic linear map")
+    format_map.generate_basic_ledmap(num_leds) # creates out/ledmap0.json
+    led_control_wled.apply_ledmap(WLED_IP, "ledmap0")
+
+    print("Creating basic linear segment")
+    led_control_wled.set_linear_segment(WLED_IP, num_leds)
+
+    brightness, threshold = await get_calibration(WLED_IP, num_leds)
+
+    locations = await map_leds(brightness, threshold, num_leds)
+    width, height = create_ledmap(locations)
 
     get_user_confirmation("Upload this ledmap to WLED?")
     print("Proceeding to upload ledmap to WLED")
     ledmap_id = led_control_wled.apply_ledmap(WLED_IP, LED_MAP_OUTPUT_NAME)
+    if ledmap_id is None:
+        print("Couldn't set", LED_MAP_OUTPUT_NAME, "on WLED")
+        return
     led_control_wled.set_2d_segment(WLED_IP, width, height, ledmap_id)
 
+    if VERIFY_LEDMAP and len(CAMERA_IDS) <= 1:
+        await verify_and_remap(WLED_IP, ledmap_id, brightness, threshold, locations)
+
     print("All done")
 
 
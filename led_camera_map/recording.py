@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# Records every captured frame of a mapping run, so detection can be rerun later with
+# other settings without flashing the LEDs again:
+#
+#   python -m led_camera_map.recording out/recording --threshold 120
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import json
+import os
+
+import numpy as np
+
+from led_camera_map import camera
+
+FRAMES_FILE = "frames.npy"
+INDEX_FILE = "index.json"
+DARK_FRAME_FILE = "dark_frame.npy"
+
+
+def get_recording_dir(output_dir="out", remap=False):
+    # Runs that only flash some LEDs (CHECKPOINT_MODE or a remap after verification)
+    # each get their own folder, so they don't overwrite the full recording
+    if not remap:
+        return output_dir + "/recording"
+    number = 1
+    while os.path.exists(output_dir + "/recording_remap" + str(number)):
+        number += 1
+    return output_dir + "/recording_remap" + str(number)
+
+
+class SessionRecorder:
+    # Frames go into one preallocated memory-mapped .npy file, one BGR frame per
+    # slot. index.json says which LEDs each frame shows, in which colour channel,
+    # when the ArtNet packet went out and when the camera delivered the frame.
+    def __init__(self, path, num_frames, frame_shape, mode, num_leds, threshold):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._frames = np.lib.format.open_memmap(
+            path + "/" + FRAMES_FILE,
+            mode="w+",
+            dtype=np.uint8,
+            shape=(num_frames, *frame_shape),
+        )
+        self._index = {
+            "mode": mode,
+            "num_leds": num_leds,
+            "threshold": threshold,
+            # The threshold applies to the difference with the dark frame if true
+            "dark_frame": False,
+            "frame_shape": list(frame_shape),
+            "frames": [],
+        }
+
+    def add(self, frame, leds, channels, sent_at, captured_at, pattern=None):
+        # pattern is (bit, complement) for gray code frames. A missing frame stays black
+        if frame is not None:
+            self._frames[len(self._index["frames"])] = frame
+        self._index["frames"].append(
+            {
+                "leds": list(leds),
+                "channels": list(channels),
+                "pattern": pattern,
+                "sent_at": sent_at,
+                "captured_at": captured_at,
+            }
+        )
+
+    def save_dark_frame(self, dark_frame):
+        np.save(self.path + "/" + DARK_FRAME_FILE, dark_frame)
+        self._index["dark_frame"] = True
+
+    def close(self):
+        self._frames.flush()
+        del self._frames
+        with open(self.path + "/" + INDEX_FILE, "w", encoding="utf-8") as index_file:
+            json.dump(self._index, index_file)
+        print("Recorded", len(self._index["frames"]), "frames to", self.path)
+
+
+def load_index(path):
+    with open(path + "/" + INDEX_FILE, encoding="utf-8") as index_file:
+        return json.load(index_file)
+
+
+def load_frames(path):
+    return np.load(path + "/" + FRAMES_FILE, mmap_mode="r")
+
+
+def load_dark_frame(path):
+    dark_frame_path = path + "/" + DARK_FRAME_FILE
+    if not os.path.exists(dark_frame_path):
+        return None
+    return np.load(dark_frame_path)
+
+
+# Each worker process maps the recording once instead of being sent the frames
+WORKER_FRAMES = None
+WORKER_DARK_FRAME = None
+
+
+def init_worker(path, use_dark_frame):
+    global WORKER_FRAMES, WORKER_DARK_FRAME
+    WORKER_FRAMES = load_frames(path)
+    WORKER_DARK_FRAME = load_dark_frame(path) if use_dark_frame else None
+
+
+def detect_recorded_led(frame_index, channel, threshold, minimum_dimension):
+    location, _, _ = camera.get_led_position(
+        np.asarray(WORKER_FRAMES[frame_index]),
+        threshold,
+        minimum_dimension=minimum_dimension,
+        dark_frame=WORKER_DARK_FRAME,
+        channel=channel,
+        debug_images=False,
+    )
+    return location
+
+
+def reprocess_recording(
+    path, threshold=None, minimum_dimension=0, use_dark_frame=None, workers=None
+):
+    # The recorded threshold and dark frame setting are used unless given
+    index = load_index(path)
+    num_leds = index["num_leds"]
+    if threshold is None:
+        threshold = index["threshold"]
+    if use_dark_frame is None:
+        use_dark_frame = index.get("dark_frame", False)
+    if index["mode"] == "gray_code":
+        frames = load_frames(path)
+        frame_pairs = [
+            (np.asarray(frames[pattern_index]), np.asarray(frames[pattern_index + 1]))
+            for pattern_index in range(0, len(index["frames"]), 2)
+        ]
+        return camera.decode_gray_code_frames(frame_pairs, threshold, num_leds)
+
+    locations = [(-1, -1)] * num_leds
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=init_worker, initargs=(path, use_dark_frame)
+    ) as pool:
+        futures = {
+            pool.submit(
+                detect_recorded_led, frame_index, channel, threshold, minimum_dimension
+            ): i
+            for frame_index, entry in enumerate(index["frames"])
+            for i, channel in zip(entry["leds"], entry["channels"])
+        }
+        for future in concurrent.futures.as_completed(futures):
+            locations[futures[future]] = future.result()
+    return locations
+
+
+def main():
+    # Imported here, the mapping script imports this module too
+    from led_camera_map import mapping
+
+    parser = argparse.ArgumentParser(
+        description="Rerun LED detection over a recorded mapping session"
+    )
+    parser.add_argument("recording", help="Directory the session was recorded to")
+    parser.add_argument("--threshold", type=int, help="Defaults to the recorded one")
+    parser.add_argument("--minimum-dimension", type=int, default=0)
+    parser.add_argument(
+        "--dark-frame",
+        action=argparse.BooleanOptionalAction,
+        help="Subtract the recorded dark frame, defaults to what the run did",
+    )
+    parser.add_argument("--workers", type=int, help="Defaults to one per CPU")
+    parser.add_argument("--output-dir", default="out/reprocessed")
+    args = parser.parse_args()
+
+    locations = reprocess_recording(
+        args.recording,
+        args.threshold,
+        args.minimum_dimension,
+        args.dark_frame,
+        args.workers,
+    )
+    found = sum(location != (-1, -1) for location in locations)
+    print("Found", found, "of", len(locations), "LEDs")
+    os.makedirs(args.output_dir, exist_ok=True)
+    locations_path = args.output_dir + "/locations.json"
+    with open(locations_path, "w", encoding="utf-8") as locations_file:
+        json.dump(locations, locations_file)
+    frames = load_frames(args.recording)
+    mapping.create_ledmap(locations, args.output_dir, np.asarray(frames[0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import bisect
+import math
+
+# Steps between strip neighbours needed before the typical step is trusted
+MIN_STEPS = 8
+
+
+class GridIndex:
+    # LED locations hashed into square cells of cell_size pixels. Everything within
+    # cell_size of a location is in its own cell or one of the eight around it, so a
+    # lookup only looks at a handful of LEDs, however many were found.
+    def __init__(self, cell_size: float) -> None:
+        self.cell_size = max(1.0, cell_size)
+        self._cells: dict[tuple[int, int], set[int]] = {}
+        self._locations: dict[int, tuple[int, int]] = {}
+
+    def _cell(self, location):
+        return (
+            math.floor(location[0] / self.cell_size),
+            math.floor(location[1] / self.cell_size),
+        )
+
+    def add(self, i: int, location: tuple[int, int]) -> None:
+        self.remove(i)
+        self._locations[i] = location
+        self._cells.setdefault(self._cell(location), set()).add(i)
+
+    def remove(self, i: int) -> None:
+        location = self._locations.pop(i, None)
+        if location is None:
+            return
+        cell = self._cell(location)
+        self._cells[cell].discard(i)
+        if not self._cells[cell]:
+            del self._cells[cell]
+
+    def nearby(self, location, distance: float) -> list[int]:
+        # LEDs closer than distance, which must not be more than cell_size
+        cell_x, cell_y = self._cell(location)
+        found = []
+        for x in (cell_x - 1, cell_x, cell_x + 1):
+            for y in (cell_y - 1, cell_y, cell_y + 1):
+                for i in self._cells.get((x, y), ()):
+                    other = self._locations[i]
+                    if math.dist(location, other) < distance:
+                        found.append(i)
+        return found
+
+
+class LocationChecker:
+    # Checks every location as it comes in and returns the LEDs it now distrusts:
+    # - "duplicate": closer than duplicate_distance to another LED. Two LEDs can't be
+    #   in the same spot, so one of them is a reflection or was detected twice.
+    # - "outlier": far from both its strip neighbours while they are close to each
+    #   other, like a reflection on a nearby surface. Far means more than
+    #   outlier_factor times the typical step between neighbouring LEDs.
+    # Each LED is reported once per run. known_locations are checked against but not
+    # reported on their own.
+    def __init__(
+        self,
+        num_leds: int,
+        known_locations=None,
+        duplicate_distance: float = 3,
+        outlier_factor: float = 4,
+    ) -> None:
+        self.num_leds = num_leds
+        self.duplicate_distance = duplicate_distance
+        self.outlier_factor = outlier_factor
+        self.flagged: dict[int, str] = {}
+        self._index = GridIndex(duplicate_distance)
+        self._locations: list[tuple[int, int] | None] = [None] * num_leds
+        self._steps: list[float] = []  # Sorted, for the median
+        self._unchecked: set[int] = set()  # Waiting for enough steps
+        for i, location in enumerate(known_locations or []):
+            if location is not None and location != (-1, -1):
+                self._locations[i] = location
+                self._index.add(i, location)
+                self._add_step(i - 1, i)
+
+    def _get(self, i):
+        if 0 <= i < self.num_leds:
+            return self._locations[i]
+        return None
+
+    def _add_step(self, i, j):
+        # Only called once per pair, when the later of the two is found
+        a, b = self._get(i), self._get(j)
+        if a is not None and b is not None:
+            bisect.insort(self._steps, math.dist(a, b))
+
+    def _remove_step(self, i, j):
+        a, b = self._get(i), self._get(j)
+        if a is not None and b is not None:
+            del self._steps[bisect.bisect_left(self._steps, math.dist(a, b))]
+
+    def typical_step(self) -> float:
+        step = self._steps[len(self._steps) // 2] if self._steps else 0
+        return max(step, self.duplicate_distance)
+
+    def _is_outlier(self, i):
+        previous, location, following = (
+            self._get(i - 1),
+            self._get(i),
+            self._get(i + 1),
+        )
+        if previous is None or location is None or following is None:
+            return False
+        limit = self.outlier_factor * self.typical_step()
+        return (
+            math.dist(previous, location) > limit
+            and math.dist(location, following) > limit
+            and math.dist(previous, following) <= limit
+        )
+
+    def _flag(self, i, reason, new_flags):
+        if i not in self.flagged:
+            self.flagged[i] = reason
+            new_flags.append((i, reason))
+
+    def add(self, i: int, location: tuple[int, int]) -> list[tuple[int, str]]:
+        # Returns (LED, reason) for every LED this location made suspicious
+        new_flags: list[tuple[int, str]] = []
+        if self._locations[i] is not None:
+            # Found again, the old location no longer counts
+            self._remove_step(i - 1, i)
+            self._remove_step(i, i + 1)
+            self._index.remove(i)
+            self._locations[i] = None
+        if location == (-1, -1):
+            return new_flags
+
+        duplicates = self._index.nearby(location, self.duplicate_distance)
+        for j in duplicates:
+            self._flag(j, "duplicate", new_flags)
+        if duplicates:
+            self._flag(i, "duplicate", new_flags)
+        self._locations[i] = location
+        self._index.add(i, location)
+        self._add_step(i - 1, i)
+        self._add_step(i, i + 1)
+
+        # Adding i can decide whether i or either neighbour is out of line
+        self._unchecked.update(
+            j for j in (i - 1, i, i + 1) if self._get(j) is not None
+        )
+        if len(self._steps) >= MIN_STEPS:
+            for j in sorted(self._unchecked):
+                if self._is_outlier(j):
+                    self._flag(j, "outlier", new_flags)
+            self._unchecked.clear()
+        return new_flags
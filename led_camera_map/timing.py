@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Opt-in timing of each mapping stage. While disabled, span() only costs a flag check.
+ENABLED = False
+# (stage, start, duration, thread id, args), times in seconds from time.perf_counter
+SPANS: list[tuple[str, float, float, int, dict]] = []
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+    SPANS.clear()
+
+
+def record(stage, start, duration, **args):
+    if ENABLED:
+        SPANS.append((stage, start, duration, threading.get_ident(), args))
+
+
+@contextmanager
+def span(stage, **args):
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, start, time.perf_counter() - start, **args)
+
+
+def record_http_response(response, *_args, **_kwargs):
+    # requests response hook: elapsed is the time until the response headers arrived
+    duration = response.elapsed.total_seconds()
+    record(
+        "http." + response.request.method.lower(),
+        time.perf_counter() - duration,
+        duration,
+        url=response.url,
+        status=response.status_code,
+    )
+
+
+def get_stage_durations():
+    durations: dict[str, list[float]] = {}
+    for stage, _, duration, _, _ in SPANS:
+        durations.setdefault(stage, []).append(duration)
+    return durations
+
+
+def format_histogram(durations, width=30):
+    # Counts per power-of-two millisecond bucket
+    buckets: dict[int, int] = {}
+    for duration in durations:
+        bucket = max(0, math.ceil(math.log2(max(duration * 1000, 1e-3))))
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+    most = max(buckets.values())
+    lines = []
+    for bucket in range(min(buckets), max(buckets) + 1):
+        count = buckets.get(bucket, 0)
+        bar = "#" * math.ceil(count / most * width) if count else ""
+        lines.append(f"    <= {2 ** bucket:>6} ms {count:>6} {bar}")
+    return "\n".join(lines)
+
+
+def print_summary():
+    if not SPANS:
+        return
+    print("Timing per stage (ms):")
+    print(
+        f"{'stage':<24}{'count':>7}{'total':>11}"
+        f"{'mean':>9}{'p50':>9}{'p95':>9}{'max':>9}"
+    )
+    for stage, durations in sorted(get_stage_durations().items()):
+        durations_ms = sorted(duration * 1000 for duration in durations)
+        count = len(durations_ms)
+        print(
+            f"{stage:<24}{count:>7}{sum(durations_ms):>11.1f}"
+            f"{sum(durations_ms) / count:>9.2f}"
+            f"{durations_ms[count // 2]:>9.2f}"
+            f"{durations_ms[min(count - 1, count * 95 // 100)]:>9.2f}"
+            f"{durations_ms[-1]:>9.2f}"
+        )
+    for stage, durations in sorted(get_stage_durations().items()):
+        print(stage)
+        print(format_histogram(durations))
+
+
+def export_chrome_trace(path):
+    # Loads in chrome://tracing, Perfetto or speedscope
+    pid = os.getpid()
+    events = [
+        {
+            "name": stage,
+            "cat": stage.split(".")[0],
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": duration * 1e6,
+            "pid": pid,
+            "tid": thread_id,
+            "args": args,
+        }
+        for stage, start, duration, thread_id, args in SPANS
+    ]
+    with open(path, "w", encoding="utf-8") as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+    print("Saved timing trace to", path)
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import json
+
+import cv2 as cv
+import numpy as np
+
+
+def load_camera_poses(path) -> dict[int, dict[str, np.ndarray]]:
+    # A JSON list with one entry per camera, as cv.calibrateCamera and cv.solvePnP
+    # give them: camera_id, camera_matrix (3x3), dist_coeffs, rvec and tvec.
+    # All cameras' rvec/tvec must be relative to the same world coordinates.
+    with open(path, encoding="utf-8") as poses_file:
+        entries = json.load(poses_file)
+    camera_poses = {}
+    for entry in entries:
+        rotation, _ = cv.Rodrigues(np.array(entry["rvec"], dtype=np.float64))
+        translation = np.array(entry["tvec"], dtype=np.float64).reshape(3, 1)
+        camera_poses[entry["camera_id"]] = {
+            "camera_matrix": np.array(entry["camera_matrix"], dtype=np.float64),
+            "dist_coeffs": np.array(entry.get("dist_coeffs", []), dtype=np.float64),
+            # Projects world points to undistorted, normalized image coordinates
+            "projection": np.hstack((rotation, translation)),
+        }
+    return camera_poses
+
+
+def undistort_location(location, camera_pose):
+    point = np.array([[location]], dtype=np.float64)
+    normalized = cv.undistortPoints(
+        point, camera_pose["camera_matrix"], camera_pose["dist_coeffs"]
+    )
+    return normalized[0, 0]
+
+
+def triangulate_location(locations, camera_poses, max_error=0.01):
+    # locations maps camera ids to where that camera saw the LED. Every camera that
+    # saw it adds two rows to a linear system (DLT), solved by SVD. Returns None if
+    # fewer than two cameras saw the LED or the views don't agree.
+    views = [
+        (undistort_location(location, camera_poses[camera_id]), camera_id)
+        for camera_id, location in locations.items()
+        if location != (-1, -1) and camera_id in camera_poses
+    ]
+    if len(views) < 2:
+        return None
+
+    rows = []
+    for (x, y), camera_id in views:
+        projection = camera_poses[camera_id]["projection"]
+        rows.append(x * projection[2] - projection[0])
+        rows.append(y * projection[2] - projection[1])
+    _, _, vt = np.linalg.svd(np.array(rows))
+    homogeneous = vt[-1]
+    if abs(homogeneous[3]) < 1e-12:
+        return None
+    point = homogeneous[:3] / homogeneous[3]
+
+    # Reprojection error in normalized coordinates, so it doesn't depend on resolution
+    for (x, y), camera_id in views:
+        projected = camera_poses[camera_id]["projection"] @ np.append(point, 1)
+        if projected[2] <= 0:
+            return None  # Behind the camera
+        error = np.hypot(
+            projected[0] / projected[2] - x, projected[1] / projected[2] - y
+        )
+        if error > max_error:
+            return None
+    return tuple(float(value) for value in point)
+
+
+def triangulate_locations(locations_by_camera, camera_poses, max_error=0.01):
+    # locations_by_camera maps camera ids to one location list per camera, in LED
+    # order. Returns one (x, y, z) or None per LED.
+    num_leds = max(len(locations) for locations in locations_by_camera.values())
+    positions = []
+    for i in range(num_leds):
+        locations = {
+            camera_id: locations[i]
+            for camera_id, locations in locations_by_camera.items()
+            if i < len(locations)
+        }
+        positions.append(triangulate_location(locations, camera_poses, max_error))
+    missing = sum(position is None for position in positions)
+    if missing:
+        print(missing, "LEDs weren't seen by two cameras that agree on where they are")
+    return positions
+
+
+def save_3d_positions(positions, output_dir="out"):
+    path = output_dir + "/positions_3d.json"
+    with open(path, "w", encoding="utf-8") as positions_file:
+        json.dump(positions, positions_file)
+    print("Saved 3D LED positions to", path)
+
+
+def load_3d_positions(output_dir="out"):
+    with open(output_dir + "/positions_3d.json", encoding="utf-8") as positions_file:
+        return [
+            None if position is None else tuple(position)
+            for position in json.load(positions_file)
+        ]
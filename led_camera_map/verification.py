@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import json
+import math
+
+import cv2 as cv
+import numpy as np
+
+
+def get_sweep_patterns(width, height, max_patterns=64):
+    # Row sweeps, then column sweeps over the 2D layout, as (axis, band, area) with
+    # area being (start, stop, start_y, stop_y). Every band is one row or column wide
+    # if that fits into max_patterns, otherwise several.
+    row_band = math.ceil(height / max(1, max_patterns // 2))
+    column_band = math.ceil(width / max(1, max_patterns // 2))
+    patterns = []
+    for band, y in enumerate(range(0, height, row_band)):
+        patterns.append(("row", band, (0, width, y, min(height, y + row_band))))
+    for band, x in enumerate(range(0, width, column_band)):
+        patterns.append(("column", band, (x, min(width, x + column_band), 0, height)))
+    return patterns, column_band, row_band
+
+
+def sample_brightness(frame, locations, radius=2):
+    # Brightness at every LED's location, or near it, since a location is the centre
+    # of a bounding box and not necessarily the brightest pixel
+    gray_image = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+    size = 2 * radius + 1
+    gray_image = cv.dilate(gray_image, np.ones((size, size), dtype=np.uint8))
+    points = np.array(locations, dtype=np.int64).reshape(-1, 2)
+    height, width = gray_image.shape
+    xs = np.clip(points[:, 0], 0, width - 1)
+    ys = np.clip(points[:, 1], 0, height - 1)
+    return gray_image[ys, xs]
+
+
+def find_mismapped_leds(
+    locations, cells, patterns, samples, threshold, column_band, row_band
+):
+    # cells holds the (column, row) every LED should have, worked out from its
+    # location and not read back from the uploaded map, so a map that WLED reads
+    # differently than it was built is caught too. samples holds one row per pattern
+    # with the brightness at every LED's location. An LED is mis-mapped when its
+    # location was brightest during another band than the one its cell is in, or
+    # never lit up at all.
+    samples = np.asarray(samples, dtype=np.int64).reshape(len(patterns), -1)
+    axes = np.array([axis for axis, _, _ in patterns])
+    bands = np.array([band for _, band, _ in patterns])
+    observed = np.full(cells.shape, -1, dtype=np.int64)
+    for index, axis in enumerate(("column", "row")):
+        axis_samples = samples[axes == axis]
+        if len(axis_samples) == 0:
+            continue
+        brightest = axis_samples.argmax(axis=0)
+        lit = axis_samples.max(axis=0) > threshold
+        observed[:, index] = np.where(lit, bands[axes == axis][brightest], -1)
+    expected = cells // np.array([column_band, row_band])
+
+    points = np.array(locations, dtype=np.int64).reshape(-1, 2)
+    checked = (points != -1).any(axis=1) & (cells != -1).all(axis=1)
+    wrong = checked & (observed != expected).any(axis=1)
+    return [
+        {
+            "led": int(i),
+            "location": points[i].tolist(),
+            "expected": expected[i].tolist(),
+            "observed": observed[i].tolist(),
+        }
+        for i in np.flatnonzero(wrong)
+    ]
+
+
+def save_verification(errors, output_dir="out"):
+    # expected and observed are (column band, row band), -1 if the LED never lit up
+    path = output_dir + "/verification.json"
+    with open(path, "w", encoding="utf-8") as verification_file:
+        json.dump(errors, verification_file, indent=1)
+    print("Saved the verification errors to", path)
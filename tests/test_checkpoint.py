@@ -0,0 +1,66 @@
+from led_camera_map import checkpoint
+
+
+def write_records(path, records, resume=False):
+    with checkpoint.open_checkpoint(path, resume=resume) as checkpoint_file:
+        for record in records:
+            checkpoint.append_checkpoint(checkpoint_file, *record)
+
+
+def test_records_round_trip(tmp_path):
+    path = str(tmp_path / "checkpoint.bin")
+    write_records(path, [(0, (10, 20)), (1, (-1, -1)), (2, (30, 40), 1)])
+    assert checkpoint.load_checkpoint(path) == {
+        0: ((10, 20), 0),
+        1: ((-1, -1), 0),
+        2: ((30, 40), checkpoint.FLAG_OUTLIER),
+    }
+
+
+def test_later_records_win(tmp_path):
+    path = str(tmp_path / "checkpoint.bin")
+    write_records(path, [(0, (10, 20)), (0, (11, 21), checkpoint.FLAG_OUTLIER)])
+    write_records(path, [(0, (12, 22))], resume=True)
+    assert checkpoint.load_checkpoint(path) == {0: ((12, 22), 0)}
+
+
+def test_fresh_run_throws_the_old_checkpoint_away(tmp_path):
+    path = str(tmp_path / "checkpoint.bin")
+    write_records(path, [(0, (10, 20)), (1, (30, 40))])
+    write_records(path, [(5, (1, 2))])
+    assert checkpoint.load_checkpoint(path) == {5: ((1, 2), 0)}
+
+
+def test_resume_drops_a_record_cut_short(tmp_path):
+    path = str(tmp_path / "checkpoint.bin")
+    write_records(path, [(0, (10, 20)), (1, (30, 40))])
+    with open(path, "ab") as checkpoint_file:
+        checkpoint_file.write(checkpoint.RECORD.pack(2, 50, 60, 0)[:5])
+    assert checkpoint.load_checkpoint(path) == {0: ((10, 20), 0), 1: ((30, 40), 0)}
+
+    write_records(path, [(2, (50, 60))], resume=True)
+    assert checkpoint.load_checkpoint(path) == {
+        0: ((10, 20), 0),
+        1: ((30, 40), 0),
+        2: ((50, 60), 0),
+    }
+
+
+def test_missing_checkpoint_loads_empty(tmp_path):
+    assert checkpoint.load_checkpoint(str(tmp_path / "missing.bin")) == {}
+
+
+def test_resume_index_is_the_first_missing_led():
+    assert checkpoint.get_resume_index({}) == 0
+    records = {0: ((1, 1), 0), 1: ((2, 2), 0), 3: ((4, 4), 0)}
+    assert checkpoint.get_resume_index(records) == 2
+
+
+def test_leds_to_remap():
+    records = {
+        0: ((1, 1), 0),
+        1: ((-1, -1), 0),
+        2: ((3, 3), checkpoint.FLAG_OUTLIER),
+        4: ((5, 5), 0),
+    }
+    assert checkpoint.get_leds_to_remap(records, 6) == [1, 2, 3, 5]
@@ -0,0 +1,48 @@
+from led_camera_map import format_map
+
+
+def test_grid_size_with_a_horizontal_line():
+    assert format_map.get_quantized_grid_size(546, 0, max_cells=100) == (100, 1)
+
+
+def test_grid_size_with_a_vertical_line():
+    assert format_map.get_quantized_grid_size(0, 546, max_cells=100) == (1, 100)
+
+
+def test_grid_size_with_a_single_point():
+    assert format_map.get_quantized_grid_size(0, 0, max_cells=1) == (1, 1)
+
+
+def test_quantize_a_straight_line_into_fewer_cells_than_leds():
+    positions = [(10 * i, 50) for i in range(40)]
+    values, width, height = format_map.quantize_2d_map(positions, max_cells=30)
+    assert (width, height) == (30, 1)
+    assert len(values) == 30
+
+
+def test_maps_are_written_row_by_row():
+    positions = [(0, 0), (10, 0), (20, 0), (0, 5), (10, 5), (20, 5)]
+    values, width, height = format_map.flatten_2d_map(positions)
+    assert (width, height) == (3, 2)
+    assert list(values) == [0, 1, 2, 3, 4, 5]
+    values, _, _ = format_map.quantize_2d_map(positions, width, height)
+    assert list(values) == [0, 1, 2, 3, 4, 5]
+
+
+def test_missing_and_excluded_leds_are_left_out_of_the_map():
+    positions = [(0, 0), (-1, -1), (10, 0), (-1, -1), (20, 0)]
+    values, width, height = format_map.flatten_2d_map(positions)
+    assert (width, height) == (3, 1)
+    assert list(values) == [0, 2, 4]
+    cells = format_map.get_flat_cells(positions)
+    assert cells.tolist() == [[0, 0], [-1, -1], [1, 0], [-1, -1], [2, 0]]
+
+
+def test_map_cells_match_the_built_map():
+    positions = [(0, 0), (3, 40), (90, 7), (-1, -1), (45, 45), (46, 45), (90, 90)]
+    for size in ((None, None, None), (4, 3, None), (None, None, 6)):
+        values, width, height = format_map.build_2d_map(positions, *size)
+        cells = format_map.get_2d_map_cells(positions, *size)
+        assert list(format_map.get_row_major_map(cells, width, height)) == list(
+            values
+        )
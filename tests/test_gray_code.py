@@ -0,0 +1,53 @@
+import numpy as np
+
+from led_camera_map import camera, led_control_artnet
+
+
+def render(positions, lit, shape=(60, 80)):
+    frame = np.full((*shape, 3), 20, dtype=np.uint8)
+    for i in lit:
+        x, y = positions[i]
+        frame[y - 1 : y + 2, x - 1 : x + 2] = 255
+    return frame
+
+
+def capture_gray_code(positions):
+    num_leds = len(positions)
+    frame_pairs = []
+    for bit in range(led_control_artnet.get_gray_code_bit_count(num_leds)):
+        frame_pairs.append(
+            tuple(
+                render(
+                    positions,
+                    led_control_artnet.get_gray_code_positions(
+                        num_leds, bit, complement
+                    ),
+                )
+                for complement in (False, True)
+            )
+        )
+    return frame_pairs
+
+
+POSITIONS = [(5 + 7 * (i % 10), 5 + 9 * (i // 10)) for i in range(37)]
+
+
+def test_gray_code_round_trip():
+    frame_pairs = capture_gray_code(POSITIONS)
+    assert len(frame_pairs) == 6
+    locations = camera.decode_gray_code_frames(frame_pairs, 100, len(POSITIONS))
+    assert locations == POSITIONS
+
+
+def test_every_led_is_lit_in_exactly_one_frame_of_each_pair():
+    for bit in range(led_control_artnet.get_gray_code_bit_count(37)):
+        lit = led_control_artnet.get_gray_code_positions(37, bit, False)
+        unlit = led_control_artnet.get_gray_code_positions(37, bit, True)
+        assert sorted(lit + unlit) == list(range(37))
+
+
+def test_missing_frame_decodes_nothing():
+    frame_pairs = capture_gray_code(POSITIONS)
+    frame_pairs[2] = (frame_pairs[2][0], None)
+    locations = camera.decode_gray_code_frames(frame_pairs, 100, len(POSITIONS))
+    assert locations == [(-1, -1)] * len(POSITIONS)
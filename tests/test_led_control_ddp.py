@@ -0,0 +1,40 @@
+import asyncio
+import socket
+
+from led_camera_map import led_control_ddp
+
+
+def test_header_layout():
+    header = led_control_ddp.make_ddp_header(5, 0x01020304, 1440, push=True)
+    assert header == bytes((0x41, 5, 0x0B, 1, 0x01, 0x02, 0x03, 0x04, 0x05, 0xA0))
+
+
+def test_header_without_push():
+    header = led_control_ddp.make_ddp_header(15, 3, 6, push=False)
+    assert header == bytes((0x40, 15, 0x0B, 1, 0, 0, 0, 3, 0, 6))
+
+
+def test_only_changed_leds_are_sent():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(1)
+    frame_buffer = led_control_ddp.DdpFrameBuffer(
+        "127.0.0.1", 4, receiver.getsockname()[1]
+    )
+
+    async def show():
+        await frame_buffer.send()  # Blanks the whole strip first
+        frame_buffer.show_colors({2: (255, 0, 0)}, 128)
+        await frame_buffer.send()
+
+    try:
+        asyncio.run(show())
+        first, _ = receiver.recvfrom(2048)
+        second, _ = receiver.recvfrom(2048)
+    finally:
+        frame_buffer.close()
+        receiver.close()
+    assert first == led_control_ddp.make_ddp_header(1, 0, 12, True) + bytes(12)
+    assert second == led_control_ddp.make_ddp_header(2, 6, 3, True) + bytes(
+        (128, 0, 0)
+    )
@@ -0,0 +1,69 @@
+from led_camera_map import spatial_index
+
+
+def add_line(checker, count, step=10):
+    flags = []
+    for i in range(count):
+        flags += checker.add(i, (step * i, 0))
+    return flags
+
+
+def test_grid_index_finds_only_close_leds():
+    index = spatial_index.GridIndex(5)
+    index.add(0, (0, 0))
+    index.add(1, (4, 0))
+    index.add(2, (6, 0))
+    index.add(3, (100, 100))
+    assert sorted(index.nearby((1, 0), 5)) == [0, 1]
+    index.remove(1)
+    assert index.nearby((1, 0), 5) == [0]
+
+
+def test_duplicates_flag_both_leds_once():
+    checker = spatial_index.LocationChecker(4)
+    assert checker.add(0, (10, 10)) == []
+    assert checker.add(1, (11, 11)) == [(0, "duplicate"), (1, "duplicate")]
+    assert checker.add(2, (10, 12)) == [(2, "duplicate")]
+    assert checker.flagged == {0: "duplicate", 1: "duplicate", 2: "duplicate"}
+
+
+def test_straight_line_is_not_flagged():
+    checker = spatial_index.LocationChecker(20)
+    assert add_line(checker, 20) == []
+    assert checker.typical_step() == 10
+
+
+def test_outlier_between_close_neighbours():
+    checker = spatial_index.LocationChecker(13)
+    assert add_line(checker, 10) == []
+    assert checker.add(10, (500, 300)) == []
+    # Only known to be out of line once the LED after it is found
+    assert checker.add(11, (110, 0)) == [(10, "outlier")]
+    assert checker.add(12, (120, 0)) == []
+
+
+def test_outliers_wait_for_enough_steps():
+    checker = spatial_index.LocationChecker(5)
+    checker.add(0, (0, 0))
+    checker.add(1, (500, 300))
+    assert checker.add(2, (20, 0)) == []
+
+
+def test_found_again_replaces_the_old_location():
+    checker = spatial_index.LocationChecker(3)
+    checker.add(0, (10, 10))
+    checker.add(0, (50, 50))
+    assert checker.add(1, (11, 11)) == []
+    assert checker.add(2, (50, 51)) == [(0, "duplicate"), (2, "duplicate")]
+
+
+def test_not_found_again_removes_the_led():
+    checker = spatial_index.LocationChecker(2)
+    checker.add(0, (10, 10))
+    assert checker.add(0, (-1, -1)) == []
+    assert checker.add(1, (10, 11)) == []
+
+
+def test_new_locations_are_checked_against_known_ones():
+    checker = spatial_index.LocationChecker(3, known_locations=[(10, 10), None])
+    assert checker.add(1, (11, 10)) == [(0, "duplicate"), (1, "duplicate")]